@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/29
+Desc    :   批量写入
+不需要逐个构造orm实例的批量请求, 整批校验后使用 executemany 写入数据库.
+"""
+from marshmallow.compat import iteritems
+from marshmallow.decorators import POST_LOAD
+from marshmallow.exceptions import ValidationError
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy import update as sa_update
+from sqlalchemy.orm.interfaces import ONETOMANY
+
+from .fields import Related
+from .exception import IllegalRequestData
+from .utils import add_padding_callback, check_need_modify
+from .schema import default_create, default_update, default_delete, default_completed
+from .sa_util import get_instances_by_identities, chunks, identity_filter, primary_key_attrs, get_model_info
+
+# ModelSchema 自带的 post_load, 批量写入时不调用
+_MODEL_POST_LOADS = frozenset(("prefetch_instances", "make_instance"))
+
+# {(check, schema): bool}
+_bulk_schemas = {}
+
+
+def _is_bulk_schema(schema):
+    """
+    schema 是否可以批量写入: 使用默认的 create/created 回调, 没有自定义的 post_load,
+    所有可写字段都是数据库字段或者 fields.Related
+    """
+    opts = schema.opts
+    if not opts.bulk_write:
+        return False
+    if opts.create is not default_create or opts.created is not default_completed:
+        return False
+    for pass_many in (True, False):
+        for attr_name in schema.__processors__.get((POST_LOAD, pass_many), []):
+            if attr_name not in _MODEL_POST_LOADS:
+                return False
+    column_keys = get_model_info(opts.model).column_keys
+    for name, field in iteritems(schema._declared_fields):
+        if field.dump_only or isinstance(field, Related):
+            continue
+        if (field.attribute or name) not in column_keys:
+            return False
+    return True
+
+
+def _is_bulk_deletable(schema):
+    """
+    schema 是否可以按主键批量删除: 使用默认的 delete/deleted 回调,
+    且删除时不需要orm处理关联数据(级联删除, 置空子资源外键, 多对多关联表)
+    """
+    opts = schema.opts
+    if not opts.bulk_write:
+        return False
+    if opts.delete is not default_delete or opts.deleted is not default_completed:
+        return False
+    mapper = sa_inspect(opts.model)
+    if len(mapper.tables) != 1:
+        return False
+    for prop in mapper.relationships:
+        if prop.cascade.delete or prop.secondary is not None:
+            return False
+        if prop.direction is ONETOMANY and not prop.passive_deletes:
+            return False
+    return True
+
+
+def _is_bulk_updatable(schema):
+    """
+    schema 是否可以使用 UPDATE 语句直接修改: 使用默认的 update/updated 回调
+    """
+    opts = schema.opts
+    if not opts.bulk_write:
+        return False
+    return opts.update is default_update and opts.updated is default_completed
+
+
+def _cached_check(check, schema):
+    key = (check, schema)
+    ret = _bulk_schemas.get(key)
+    if ret is None:
+        ret = _bulk_schemas[key] = check(schema)
+    return ret
+
+
+def is_bulk_schema(schema):
+    return _cached_check(_is_bulk_schema, schema)
+
+
+def is_bulk_deletable(schema):
+    return _cached_check(_is_bulk_deletable, schema)
+
+
+def is_bulk_updatable(schema):
+    return _cached_check(_is_bulk_updatable, schema)
+
+
+def _related_load_keys(schema):
+    keys = set()
+    for name, field in iteritems(schema._declared_fields):
+        if isinstance(field, Related) and not field.dump_only:
+            keys.add(field.load_from or name)
+    return keys
+
+
+def is_bulk_creatable(schema, data):
+    """
+    批量创建的数据是否可以使用批量写入. 包含子资源的数据仍然逐个创建
+    :param schema: ModelSchema class
+    :param data: 请求数据列表
+    :return:
+    """
+    if not data or not is_bulk_schema(schema):
+        return False
+    related_keys = _related_load_keys(schema)
+    for item in data:
+        if not isinstance(item, dict):
+            # 交给marshmallow返回错误
+            return False
+        if related_keys and not related_keys.isdisjoint(item):
+            return False
+    return True
+
+
+def load_mappings(schema, data):
+    """
+    整批校验并反序列化, 不构造orm实例
+    :param schema: ModelSchema class
+    :param data: 请求数据列表
+    :return: [{attribute: value}]
+    """
+    schema_ins = schema(check_existence=False, many=True)
+    result, errors = schema_ins._do_load(data, many=True, postprocess=False)
+    if errors:
+        raise ValidationError(errors, data=result)
+    return result
+
+
+def is_directly_updatable(schema, data):
+    """
+    单个资源的修改是否可以直接使用 UPDATE 语句: 使用默认 update/updated 回调, 且数据中没有主键和子资源
+    :param schema: ModelSchema class
+    :param data: 请求数据
+    :return:
+    """
+    if not isinstance(data, dict) or not is_bulk_updatable(schema):
+        return False
+    # 数据中包含主键时由 schema_load 处理
+    pk_keys = get_model_info(schema.opts.model).pk_keys
+    return all(key not in data for key in pk_keys) and _related_load_keys(schema).isdisjoint(data)
+
+
+def update_one(session, model, filters, values):
+    """
+    修改单个资源, 不预先查询. SQLAlchemy 2.0 且数据库支持(dialect.update_returning)时使用 UPDATE ... RETURNING
+    一次完成修改和查询, 否则只执行 UPDATE, 由调用者再查询修改后的资源
+    :param session:
+    :param model: sa orm model
+    :param filters: 查找资源的条件
+    :param values: load_update_values 的结果
+    :return: (修改的行数, 修改后的实例). 不支持 RETURNING 时实例为None
+    """
+    if getattr(session.get_bind(mapper=sa_inspect(model)).dialect, "update_returning", False):
+        stmt = sa_update(model).where(*filters).values(**values).returning(model)
+        instance = session.execute(stmt).scalars().first()
+        return (0 if instance is None else 1), instance
+    count = session.query(model).filter(*filters).update(values, synchronize_session=False)
+    return count, None
+
+
+def load_update_values(schema, data):
+    """
+    校验部分更新的数据, 只能修改数据库字段, 不能修改主键
+    :param schema: ModelSchema class
+    :param data: 请求数据
+    :return: {attribute: value}
+    """
+    if not isinstance(data, dict):
+        raise IllegalRequestData({
+            u"msg": u"请求数据必须为对象",
+            u"data": data,
+        })
+    related_keys = _related_load_keys(schema)
+    if not related_keys.isdisjoint(data):
+        raise IllegalRequestData({
+            u"msg": u"不支持修改子资源",
+            u"data": data,
+        })
+    schema_ins = schema(check_existence=False)
+    values, errors = schema_ins._do_load(data, many=False, partial=True, postprocess=False)
+    if errors:
+        raise ValidationError(errors, data=values)
+    info = get_model_info(schema.opts.model)
+    for key in values:
+        if key not in info.column_keys or key in info.pk_keys:
+            raise IllegalRequestData({
+                u"msg": u"无法修改该字段",
+                u"data": data,
+                u"field": key,
+            })
+    if not values:
+        raise IllegalRequestData({
+            u"msg": u"没有需要修改的字段",
+            u"data": data,
+        })
+    return values
+
+
+def _update_returning(session, model, query, values):
+    """
+    UPDATE ... RETURNING 一次返回修改的主键
+    """
+    stmt = sa_update(model).where(query.whereclause).values(**values).returning(
+        *primary_key_attrs(model, sa_inspect(model))
+    )
+    return [tuple(row) for row in session.execute(stmt)]
+
+
+def update_by_query(session, schema, query, values, returning=False):
+    """
+    按查询条件修改. 使用默认 update/updated 回调时只执行一条 UPDATE 语句
+    :param session:
+    :param schema: ModelSchema class
+    :param query: 只包含查询条件的 session.query(model)
+    :param values: load_update_values 的结果
+    :param returning: 是否返回修改的主键
+    :return: (修改的行数, 主键 tuple 列表 或者 None)
+    """
+    opts = schema.opts
+    model = opts.model
+    if not is_bulk_updatable(schema):
+        instances = query.all()
+        for instance in instances:
+            if check_need_modify(instance, values):
+                instance = opts.update(instance, dict(values))
+                add_padding_callback(opts.updated, instance)  # commit数据库之后调用
+        identities = [sa_inspect(instance).identity for instance in instances] if returning else None
+        return len(instances), identities
+    if not returning:
+        return query.update(values, synchronize_session=False), None
+    if getattr(session.get_bind(mapper=sa_inspect(model)).dialect, "update_returning", False):
+        identities = _update_returning(session, model, query, values)
+        return len(identities), identities
+    # 先查询主键, 再按主键修改, 返回的资源与修改的行一致
+    pk_attrs = primary_key_attrs(model, sa_inspect(model))
+    identities = [tuple(row) for row in query.with_entities(*pk_attrs)]
+    count = 0
+    for chunk in chunks(identities):
+        count += session.query(model).filter(identity_filter(pk_attrs, chunk)).update(
+            values, synchronize_session=False
+        )
+    return count, identities
+
+
+def _insert_returning(connection, mapper, mappings):
+    """
+    INSERT ... RETURNING 批量写入, 返回生成的主键
+    """
+    table = mapper.local_table
+    stmt = table.insert()
+    if getattr(connection.dialect, "insert_executemany_returning_sort_by_parameter_order", False):
+        # sqlalchemy>=2.0 insertmanyvalues
+        stmt = stmt.returning(*mapper.primary_key, sort_by_parameter_order=True)
+    else:
+        stmt = stmt.returning(*mapper.primary_key)
+    # executemany 要求每行的字段相同, 按字段分组写入
+    groups = {}
+    order = []
+    for idx, mapping in enumerate(mappings):
+        row = dict((mapper.get_property(key).columns[0].key, value) for key, value in iteritems(mapping))
+        keys = frozenset(row)
+        if keys not in groups:
+            groups[keys] = []
+            order.append(keys)
+        groups[keys].append((idx, row))
+    identities = [None] * len(mappings)
+    for keys in order:
+        items = groups[keys]
+        result = connection.execute(stmt, [row for idx, row in items])
+        for (idx, row), returned in zip(items, result):
+            identities[idx] = tuple(returned)
+    return identities
+
+
+def insert_mappings(session, mapper, mappings):
+    """
+    批量写入, 返回每一行的主键.
+    已指定主键时直接 executemany; 数据库支持 executemany RETURNING 时一次取回生成的主键;
+    否则使用 bulk_insert_mappings(return_defaults=True) 逐行取回主键
+    :param session:
+    :param mapper: sa mapper
+    :param mappings: [{attribute: value}]
+    :return: 主键 tuple 列表
+    """
+    pk_keys = get_model_info(mapper.class_).pk_keys
+    if all(mapping.get(key) is not None for mapping in mappings for key in pk_keys):
+        session.bulk_insert_mappings(mapper, mappings)
+        return [tuple(mapping[key] for key in pk_keys) for mapping in mappings]
+    connection = session.connection(mapper=mapper)
+    if len(mapper.tables) == 1 and getattr(connection.dialect, "insert_executemany_returning", False):
+        return _insert_returning(connection, mapper, mappings)
+    session.bulk_insert_mappings(mapper, mappings, return_defaults=True)
+    return [tuple(mapping[key] for key in pk_keys) for mapping in mappings]
+
+
+def bulk_create(session, schema, data, options=None):
+    """
+    批量创建资源并提交
+    :param session:
+    :param schema: ModelSchema class
+    :param data: 请求数据列表
+    :param options: 重新查询时的预加载选项
+    :return: 创建的实例列表
+    """
+    mapper = sa_inspect(schema.opts.model)
+    mappings = load_mappings(schema, data)
+    identities = insert_mappings(session, mapper, mappings)
+    session.commit()
+    # 数据库生成的默认值需要重新查询
+    return get_instances_by_identities(session, mapper.class_, identities, options=options)
+
+
+def delete_identities(session, model, identities):
+    """
+    按主键批量删除, 每批一条 DELETE ... WHERE pk IN (...)
+    :param session:
+    :param model: sa orm model
+    :param identities: 主键值 tuple 列表
+    :return: 删除的行数
+    """
+    columns = primary_key_attrs(model, sa_inspect(model))
+    count = 0
+    for chunk in chunks(identities):
+        count += session.query(model).filter(identity_filter(columns, chunk)).delete(synchronize_session=False)
+    return count
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/7/2
+Desc    :   进程内缓存及其失效
+每张表有一个版本号, 写请求成功后增加相关表的版本号. 缓存条目保存写入时的版本号, 读取时版本号不一致即失效.
+多进程部署时调用 generations.use_shared(path), 各进程通过同一个 mmap 文件共享版本号, Runserver 在 workers > 1 时自动开启.
+二级缓存(model cache)按主键缓存数据库字段值, 通过 ModelSchema 的 cache_ttl 配置开启:
+class GenreSchema(ModelSchema):
+    class Meta:
+        model = Genre
+        cache_ttl = 300
+"""
+import os
+import mmap
+import zlib
+import struct
+import threading
+
+import six
+from flask import Response
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value, instance_state
+
+from .utils import LRUCache
+
+# 二级缓存的最大条目数
+MODEL_CACHE_SIZE = 10000
+
+# 响应缓存的最大条目数
+RESPONSE_CACHE_SIZE = 1000
+# 超过该大小的响应不缓存
+RESPONSE_CACHE_MAX_BYTES = 1024 * 1024
+# 小于该大小的响应不压缩
+GZIP_MIN_BYTES = 1024
+
+# 共享版本号的槽位数量. 表名按哈希分配槽位, 冲突时只会多失效一些缓存
+SHARED_SLOTS = 4096
+_COUNTER = struct.Struct("<Q")
+
+
+class SharedCounters(object):
+    """
+    mmap 文件中的计数器数组, 映射同一个文件的进程之间共享
+    """
+
+    def __init__(self, path, slots=SHARED_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * _COUNTER.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def _offset(self, name):
+        # 不能使用 hash(), python3 各进程的字符串哈希不同
+        return (zlib.crc32(name.encode("utf-8")) & 0xffffffff) % self.slots * _COUNTER.size
+
+    def get(self, name):
+        return _COUNTER.unpack_from(self._mmap, self._offset(name))[0]
+
+    def bump(self, names):
+        import fcntl
+
+        offsets = set(self._offset(name) for name in names)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for offset in offsets:
+                    _COUNTER.pack_into(self._mmap, offset, _COUNTER.unpack_from(self._mmap, offset)[0] + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+class TableGenerations(object):
+    """
+    表的版本号. 默认只在当前进程内有效
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._shared = None
+
+    def use_shared(self, path, slots=SHARED_SLOTS):
+        """
+        使用共享文件保存版本号, 一个进程的写请求会使其他进程的缓存失效
+        :param path: 各进程使用同一个文件路径
+        :param slots: 槽位数量
+        """
+        if self._shared is not None:
+            self._shared.close()
+        self._shared = SharedCounters(path, slots)
+
+    def get(self, table_name):
+        if self._shared is not None:
+            return self._shared.get(table_name)
+        return self._data.get(table_name, 0)
+
+    def get_many(self, table_names):
+        return tuple(self.get(name) for name in table_names)
+
+    def bump(self, table_names):
+        if self._shared is not None:
+            self._shared.bump(table_names)
+            return
+        with self._lock:
+            for name in table_names:
+                self._data[name] = self._data.get(name, 0) + 1
+
+
+generations = TableGenerations()
+
+# {model: (table name, ...)}
+_related_tables = {}
+
+
+def get_model_tables(model):
+    return tuple(sorted(table.name for table in sa_inspect(model).tables))
+
+
+def get_related_tables(model):
+    """
+    model 及其关系涉及的表. 修改资源时可能通过外键, 级联或关联表修改这些表
+    :param model: sa orm model
+    :return: (table name, ...)
+    """
+    ret = _related_tables.get(model)
+    if ret is None:
+        mapper = sa_inspect(model)
+        names = set(table.name for table in mapper.tables)
+        for prop in mapper.relationships:
+            names.update(table.name for table in prop.mapper.tables)
+            if prop.secondary is not None:
+                names.add(prop.secondary.name)
+        ret = _related_tables[model] = tuple(sorted(names))
+    return ret
+
+
+# {model: (table name, ...)}
+_reachable_tables = {}
+
+
+def get_reachable_tables(model):
+    """
+    通过关系可以到达的所有表. 展开的子资源可能来自这些表
+    :param model: sa orm model
+    :return: (table name, ...)
+    """
+    ret = _reachable_tables.get(model)
+    if ret is None:
+        names = set()
+        seen = set()
+        mappers = [sa_inspect(model)]
+        while mappers:
+            mapper = mappers.pop()
+            if mapper in seen:
+                continue
+            seen.add(mapper)
+            names.update(table.name for table in mapper.tables)
+            for prop in mapper.relationships:
+                if prop.secondary is not None:
+                    names.add(prop.secondary.name)
+                mappers.append(prop.mapper)
+        ret = _reachable_tables[model] = tuple(sorted(names))
+    return ret
+
+
+def get_filters_key(filters):
+    """
+    查询条件的缓存key: 编译后的sql和参数值. schema 的 filters 可能按用户或租户过滤, 必须包含在响应缓存的key中
+    :param filters: sqlalchemy 条件列表
+    :return:
+    """
+    ret = []
+    for cond in filters:
+        compiled = cond.compile()
+        ret.append((six.text_type(compiled), repr(sorted(compiled.params.items()))))
+    return tuple(ret)
+
+
+def invalidate_tables(table_names):
+    generations.bump(table_names)
+
+
+def invalidate_models(models):
+    """
+    使 models 及其关系涉及的表的缓存失效
+    """
+    names = set()
+    for model in models:
+        names.update(get_related_tables(model))
+    invalidate_tables(names)
+
+
+class ModelCache(object):
+    """
+    按主键缓存数据库字段值. 命中时直接在session中构造持久化实例, 不查询数据库
+    """
+
+    def __init__(self, maxsize=MODEL_CACHE_SIZE):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    @staticmethod
+    def generation(model):
+        return generations.get_many(get_model_tables(model))
+
+    def get(self, session, model, identity):
+        """
+        :param session:
+        :param model: sa orm model
+        :param identity: 主键值 tuple
+        :return: 实例, 未缓存时为None
+        """
+        key = (model, identity)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        generation, values = entry
+        if generation != self.generation(model):
+            self._cache.pop(key)
+            return None
+        mapper = sa_inspect(model)
+        instance = session.identity_map.get(mapper.identity_key_from_primary_key(identity))
+        if instance is not None:
+            return instance
+        instance = mapper.class_manager.new_instance()
+        for attr, value in values.items():
+            set_committed_value(instance, attr, value)
+        make_transient_to_detached(instance)
+        session.add(instance)
+        return instance
+
+    def set(self, instance, ttl, generation):
+        """
+        :param instance: 已加载的持久化实例
+        :param ttl: 过期秒数
+        :param generation: 查询之前的版本号, 查询期间有写入时不会使用旧数据
+        """
+        state = instance_state(instance)
+        if state.key is None:
+            return
+        mapper = state.mapper
+        values = {}
+        for prop in mapper.column_attrs:
+            if prop.key not in state.dict:
+                # 未加载或者已过期
+                return
+            values[prop.key] = state.dict[prop.key]
+        self._cache.set((mapper.class_, state.identity), (generation, values), ttl=ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+model_cache = ModelCache()
+
+
+class CachedResponse(object):
+    """
+    缓存的响应内容, gzip 压缩结果在第一次使用时生成
+    """
+    __slots__ = ("body", "mimetype", "_gzip_body")
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self._gzip_body = None
+
+    def gzip_body(self):
+        if self._gzip_body is None:
+            # wbits=16+MAX_WBITS 输出gzip格式
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._gzip_body = compressor.compress(self.body) + compressor.flush()
+        return self._gzip_body
+
+    def make_response(self, accept_gzip=False):
+        if accept_gzip and len(self.body) >= GZIP_MIN_BYTES:
+            response = Response(self.gzip_body(), mimetype=self.mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(self.body, mimetype=self.mimetype)
+        # 两种编码的响应都需要, 否则代理可能把未压缩的内容返回给支持gzip的客户端
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+class ResponseCache(object):
+    """
+    列表响应缓存. key 包含相关表的版本号, 写请求之后旧的条目不会再命中, 由LRU淘汰
+    """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self._cache = LRUCache(maxsize=maxsize)
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, body, mimetype, ttl):
+        """
+        :return: CachedResponse
+        """
+        entry = CachedResponse(body, mimetype)
+        if len(body) <= self.max_bytes:
+            self._cache.set(key, entry, ttl=ttl)
+        return entry
+
+    def clear(self):
+        self._cache.clear()
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/25
+Desc    :   游标(keyset)分页
+游标保存上一页最后一行的排序字段值, 下一页使用 WHERE (sort_cols) > (last_values) 查询,
+查询代价与页数无关. 排序字段的值不能为NULL.
+"""
+import json
+import base64
+import uuid
+import decimal
+import datetime
+
+import six
+from sqlalchemy import and_, or_, asc, tuple_, literal
+
+# 游标值的类型标记
+_DATETIME = "dt"
+_DATE = "d"
+_TIME = "t"
+_DECIMAL = "n"
+_UUID = "u"
+
+
+def _dump_value(value):
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        if offset is not None:
+            # 统一保存为UTC时间
+            value = value.replace(tzinfo=None) - offset
+        parts = [value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond]
+        return [_DATETIME, parts, offset is not None]
+    if isinstance(value, datetime.date):
+        return [_DATE, [value.year, value.month, value.day]]
+    if isinstance(value, datetime.time):
+        return [_TIME, [value.hour, value.minute, value.second, value.microsecond]]
+    if isinstance(value, decimal.Decimal):
+        return [_DECIMAL, str(value)]
+    if isinstance(value, uuid.UUID):
+        return [_UUID, str(value)]
+    if isinstance(value, (list, tuple)):
+        raise ValueError("unsupported cursor value: %r" % (value,))
+    return value
+
+
+def _load_value(value):
+    if not isinstance(value, list):
+        return value
+    tag, data = value[0], value[1]
+    if tag == _DATETIME:
+        ret = datetime.datetime(*data)
+        if value[2]:
+            utc = getattr(datetime, "timezone", None)
+            if utc is not None:
+                ret = ret.replace(tzinfo=utc.utc)
+        return ret
+    if tag == _DATE:
+        return datetime.date(*data)
+    if tag == _TIME:
+        return datetime.time(*data)
+    if tag == _DECIMAL:
+        return decimal.Decimal(data)
+    if tag == _UUID:
+        return uuid.UUID(data)
+    raise ValueError("unknown cursor value type: %r" % (tag,))
+
+
+def _value_types(column):
+    """
+    排序字段允许的游标值类型, 无法确定类型时返回None
+    """
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bool:
+        return (bool,)
+    if issubclass(python_type, six.integer_types):
+        return six.integer_types
+    if issubclass(python_type, (float, decimal.Decimal)):
+        return six.integer_types + (float, decimal.Decimal)
+    if issubclass(python_type, six.string_types):
+        return six.string_types
+    return (python_type,)
+
+
+def check_cursor_values(columns, values):
+    """
+    校验游标值的个数和类型与排序字段一致, 避免篡改的游标生成错误的sql
+    :param columns: 排序字段
+    :param values: decode_cursor 解析的值
+    :return: bool
+    """
+    if len(columns) != len(values):
+        return False
+    for column, value in zip(columns, values):
+        if value is None:
+            continue
+        if isinstance(value, (list, dict)):
+            return False
+        types = _value_types(column)
+        if types is not None and not isinstance(value, types):
+            return False
+    return True
+
+
+def encode_cursor(values, order_key):
+    """
+    生成不透明的游标字符串
+    :param values: 最后一行的排序字段值
+    :param order_key: 排序条件, 用于校验游标与当前排序一致
+    :return: str
+    """
+    data = json.dumps({"o": order_key, "v": [_dump_value(value) for value in values]}, separators=(",", ":"))
+    token = base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+    return token.rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    解析游标字符串
+    :param token:
+    :return: (values, order_key)
+    """
+    if isinstance(token, six.text_type):
+        token = token.encode("ascii")
+    token += b"=" * (-len(token) % 4)
+    data = json.loads(base64.urlsafe_b64decode(token).decode("utf-8"))
+    return [_load_value(value) for value in data["v"]], data["o"]
+
+
+def keyset_filter(columns, directions, values):
+    """
+    生成 (sort_cols) > (last_values) 条件. 排序方向一致时使用行值比较, 否则展开为 OR 条件
+    :param columns: 排序字段
+    :param directions: asc or desc
+    :param values: 上一页最后一行的值
+    :return:
+    """
+    assert len(columns) == len(directions) == len(values)
+
+    def compare(column, direction, value):
+        return column > value if direction is asc else column < value
+
+    if len(columns) == 1:
+        return compare(columns[0], directions[0], values[0])
+    if len(set(directions)) == 1:
+        # 使用字段类型绑定参数, 保证日期等类型的格式与字段一致
+        typed_values = [literal(value, column.type) for column, value in zip(columns, values)]
+        return compare(tuple_(*columns), directions[0], tuple_(*typed_values))
+    conditions = []
+    for idx in range(len(columns)):
+        equals = [columns[i] == values[i] for i in range(idx)]
+        conditions.append(and_(*(equals + [compare(columns[idx], directions[idx], values[idx])])))
+    return or_(*conditions)
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/27
+Desc    :   json编码后端
+使用 类型->转换方法 的分派表处理非json原生类型, 可选 orjson, ujson 加速.
+ujson 会把 Decimal 直接输出为浮点数, 需要先转换数据, auto 时不选择 ujson.
+APIManager(app, engine=engine, json_backend="auto")
+"""
+import re
+import json
+import uuid
+import decimal
+import datetime
+
+import six
+from werkzeug.http import http_date
+
+__all__ = [
+    "DEFAULT_CONVERTERS",
+    "JSONBackend",
+    "StdlibJSONBackend",
+    "OrjsonBackend",
+    "UjsonBackend",
+    "DynamicJSONEncoder",
+    "get_json_backend",
+    "escape_non_ascii",
+]
+
+_NON_ASCII_BYTES_RE = re.compile(b"[\x80-\xff]")
+_NON_ASCII_RE = re.compile(u"[^\x00-\x7f]")
+# json原生类型, 其他类型使用分派表转换
+_NATIVE_TYPES = six.string_types + six.integer_types + (float, type(None))
+
+
+def _date_converter(o):
+    return http_date(o.timetuple())
+
+
+# 非json原生类型的转换方法. 与flask JSONEncoder 保持一致, Decimal 转为字符串保证精度.
+# fields.DateTime(MysqlTimestampField), BigNumberField 等字段已经输出字符串, 不需要转换
+DEFAULT_CONVERTERS = {
+    decimal.Decimal: str,
+    datetime.datetime: _date_converter,
+    datetime.date: _date_converter,
+    uuid.UUID: str,
+}
+
+
+def _escape_char(match):
+    code = ord(match.group(0))
+    if code > 0xffff:
+        # 非BMP字符使用代理对
+        code -= 0x10000
+        return u"\\u%04x\\u%04x" % (0xd800 + (code >> 10), 0xdc00 + (code & 0x3ff))
+    return u"\\u%04x" % code
+
+
+def escape_non_ascii(data):
+    """
+    转义utf-8 json中的非ascii字符. json的结构字符都是ascii, 非ascii字符只会出现在字符串中
+    :param data: utf-8 编码的json bytes
+    :return: ascii json bytes
+    """
+    if not _NON_ASCII_BYTES_RE.search(data):
+        return data
+    return _NON_ASCII_RE.sub(_escape_char, data.decode("utf-8")).encode("ascii")
+
+
+class TypeDispatcher(object):
+    """
+    按对象类型查找转换方法, 查找结果按类型缓存
+    """
+
+    def __init__(self, converters=None):
+        self._converters = dict(DEFAULT_CONVERTERS)
+        if converters:
+            self._converters.update(converters)
+        self._cache = dict(self._converters)
+
+    def resolve(self, cls):
+        if hasattr(cls, "__json__"):
+            # 自定义的json格式, 如sqlalchemy model
+            return lambda o: o.__json__()
+        for base in cls.__mro__[1:]:
+            if base in self._converters:
+                return self._converters[base]
+        if hasattr(cls, "__html__"):
+            return lambda o: six.text_type(o.__html__())
+        return None
+
+    def __call__(self, o):
+        cls = type(o)
+        converter = self._cache.get(cls)
+        if converter is None:
+            converter = self.resolve(cls)
+            if converter is None:
+                raise TypeError("%r is not JSON serializable" % (o,))
+            self._cache[cls] = converter
+        return converter(o)
+
+
+class JSONBackend(object):
+    """
+    json编码后端, dumps 返回utf-8编码的bytes
+    """
+    name = None
+
+    def __init__(self, converters=None, ensure_ascii=False):
+        """
+        :param converters: 额外的 类型->转换方法
+        :param ensure_ascii: 是否转义非ascii字符
+        """
+        self.default = TypeDispatcher(converters)
+        self.ensure_ascii = ensure_ascii
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        raise NotImplementedError
+
+
+class StdlibJSONBackend(JSONBackend):
+    name = "stdlib"
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        ret = json.dumps(
+            obj,
+            default=self.default,
+            indent=indent,
+            sort_keys=sort_keys,
+            separators=(",", ": ") if indent else (",", ":"),
+            ensure_ascii=self.ensure_ascii,
+        )
+        if isinstance(ret, six.text_type):
+            ret = ret.encode("utf-8")
+        return ret
+
+
+class OrjsonBackend(JSONBackend):
+    name = "orjson"
+
+    @classmethod
+    def available(cls):
+        try:
+            import orjson
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self, *args, **kwargs):
+        import orjson
+
+        super(OrjsonBackend, self).__init__(*args, **kwargs)
+        self._dumps = orjson.dumps
+        # 日期交给分派表处理, 与其他后端输出一致
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        self._indent_option = orjson.OPT_INDENT_2
+        self._sort_option = orjson.OPT_SORT_KEYS
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        option = self._option
+        if indent:
+            option |= self._indent_option
+        if sort_keys:
+            option |= self._sort_option
+        ret = self._dumps(obj, default=self.default, option=option)
+        if self.ensure_ascii:
+            # orjson 不支持 ensure_ascii
+            ret = escape_non_ascii(ret)
+        return ret
+
+
+class UjsonBackend(JSONBackend):
+    name = "ujson"
+
+    @classmethod
+    def available(cls):
+        try:
+            import ujson
+            # ujson>=2.0 才支持 default 参数
+            ujson.dumps(None, default=str)
+        except (ImportError, TypeError):
+            return False
+        return True
+
+    def __init__(self, *args, **kwargs):
+        import ujson
+
+        super(UjsonBackend, self).__init__(*args, **kwargs)
+        self._dumps = ujson.dumps
+
+    def convert(self, obj):
+        """
+        预先使用分派表转换非原生类型. ujson 会把 Decimal 输出为浮点数, 并把带 __json__ 的对象当作原始json
+        """
+        if isinstance(obj, dict):
+            return dict((key, self.convert(value)) for key, value in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return [self.convert(value) for value in obj]
+        if isinstance(obj, _NATIVE_TYPES) and not hasattr(obj, "__json__"):
+            return obj
+        return self.convert(self.default(obj))
+
+    def dumps(self, obj, indent=None, sort_keys=False):
+        ret = self._dumps(
+            self.convert(obj),
+            indent=indent or 0,
+            sort_keys=sort_keys,
+            ensure_ascii=self.ensure_ascii,
+            escape_forward_slashes=False,
+        )
+        if isinstance(ret, six.text_type):
+            ret = ret.encode("utf-8")
+        return ret
+
+
+BACKENDS = {
+    StdlibJSONBackend.name: StdlibJSONBackend,
+    OrjsonBackend.name: OrjsonBackend,
+    UjsonBackend.name: UjsonBackend,
+}
+
+# auto 时的选择顺序. ujson 需要先用python转换整个数据, 不一定比标准库快
+AUTO_ORDER = (OrjsonBackend, StdlibJSONBackend)
+
+
+def get_json_backend(backend="auto", **kwargs):
+    """
+    :param backend: "auto", "stdlib", "orjson", "ujson" 或者 JSONBackend 实例
+    :param kwargs: JSONBackend 参数
+    :return: JSONBackend
+    """
+    if isinstance(backend, JSONBackend):
+        return backend
+    if backend == "auto":
+        for backend_cls in AUTO_ORDER:
+            if backend_cls.available():
+                return backend_cls(**kwargs)
+    if backend not in BACKENDS:
+        raise ValueError("unknown json backend: %r" % (backend,))
+    backend_cls = BACKENDS[backend]
+    if not backend_cls.available():
+        raise ImportError("please pip install %s" % backend)
+    return backend_cls(**kwargs)
+
+
+class DynamicJSONEncoder(json.JSONEncoder):
+    """ JSON encoder for custom classes:
+        Uses __json__() method if available to prepare the object.
+        Especially useful for SQLAlchemy models
+    """
+    dispatcher = TypeDispatcher()
+
+    def default(self, o):
+        return self.dispatcher(o)
@@ -214,7 +214,9 @@ def __database_error_handler_sqlite(source_exp):
             statement = source_exp.statement
             p = re.compile('.*?\((.*?)\).*?')
             all_fields = [item.strip(' ').strip('"') for item in p.match(statement).groups()[0].split(',')]
-            value = source_exp.params[all_fields.index(field)]
+            params = source_exp.params
+            # executemany 无法确定是哪一行
+            value = None if isinstance(params, list) else params[all_fields.index(field)]
             detail = dict(
                 table=table, field=field, value=value
             )
@@ -137,30 +137,36 @@ class Related(fields.Field):
                                  'Schema, not {0}.'.format(self.unload_schema.__class__))
         return self.__schema_class
 
+    def get_schema_class(self, parent_class):
+        """
+        不依赖schema实例获取子级Schema, 用于预加载等类级别的计算
+        :param parent_class: 字段所属的Schema类
+        :return:
+        """
+        if self.unload_schema == _RECURSIVE_NESTED:
+            return parent_class
+        return self.schema_class
+
     def _serialize(self, value, attr, obj):
+        from .ma.expand import get_child_expand
+        from .ma.plan import get_dump_plan
+
         father_schema = get_schema_for_field(self)
-        # 当前展开层级
-        expand = father_schema._current_expand
         # schema展开配置
         related_kwargs = father_schema._related_kwargs
         # 子级 schema
         schema_class = self.schema_class
 
-        dump_kwargs = dict()
-        if expand is not None:
-            dump_kwargs["expand"] = expand - 1
-
-        schema = schema_class(
-            many=self.related_prop.uselist,
-            session=getattr(father_schema, "_session", None),
+        # 使用缓存的序列化计划, 避免每个子资源都实例化schema
+        plan = get_dump_plan(
+            schema_class,
+            get_child_expand(father_schema._current_expand, self.name),
             related_kwargs=related_kwargs,
             **related_kwargs.get(schema_class, {})
         )
-
-        ret, errors = schema.dump(value, **dump_kwargs)
-        if errors:
-            raise ValidationError(errors, data=ret)
-        return ret
+        if self.related_prop.uselist and value is not None:
+            return plan.dump_many(value)
+        return plan.dump(value)
 
     def _deserialize_one(self, value, attr, data):
         father_schema = get_schema_for_field(self)
@@ -7,7 +7,9 @@ E-mail  :   windprog@gmail.com
 Date    :   17/11/8
 Desc    :   
 """
+import os
 import time
+import tempfile
 import six
 import sys
 import multiprocessing
@@ -185,6 +187,29 @@ class GunicornApplication(Application):
         return self.app
 
 
+def share_cache_generations(options):
+    """
+    多个worker时通过共享文件同步缓存的表版本号, worker fork 之后映射该文件
+    :param options: gunicorn 配置
+    """
+    fd, path = tempfile.mkstemp(prefix="rest_utils_cache_")
+    os.close(fd)
+
+    def post_fork(server, worker):
+        from .cache import generations
+
+        generations.use_shared(path)
+
+    def on_exit(server):
+        # 只在 master 退出时删除. worker 退出或重启时删除会使新的worker使用另一个文件
+        if os.path.exists(path):
+            os.remove(path)
+
+    options["post_fork"] = post_fork
+    options["on_exit"] = on_exit
+    return path
+
+
 def init_logger():
     logging.getLogger('requests').setLevel(logging.ERROR)
     logging.getLogger('werkzeug').setLevel(logging.ERROR)
@@ -265,5 +290,9 @@ class Runserver(Command):
         # 处理端口
         kwargs["bind"] = "%s:%s" % (kwargs.pop("host"), kwargs.pop("port"))
 
+        if int(kwargs.get("workers") or 1) > 1:
+            # 缓存写入之后在所有worker中失效
+            share_cache_generations(kwargs)
+
         server = GunicornApplication(app, kwargs)
         server.run()
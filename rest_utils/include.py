@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/28
+Desc    :   _include 复合文档(compound document)
+主资源只返回关联资源的主键, 关联资源在顶层的 included 中按 endpoint 和主键去重返回:
+/Track?_include=Album,Album.Artist
+{
+    "total": 1,
+    "items": [{"TrackId": 1, "Album": 1, ...}],
+    "included": {
+        "Album": {"1": {"AlbumId": 1, "Artist": 1, ...}},
+        "Artist": {"1": {"ArtistId": 1, ...}}
+    }
+}
+"""
+import six
+from marshmallow.compat import iteritems
+from sqlalchemy import orm
+from sqlalchemy import inspect as sa_inspect
+
+from .fields import Related
+from .loading import COLLECTION_LOADER
+from .exp_format import raise_args_exception
+from .ma.plan import get_dump_plan
+
+
+def iter_included_fields(schema, tree):
+    """
+    遍历路径树中的关系字段, 字段不存在时抛出参数错误
+    :param schema: ModelSchema class
+    :param tree: 如 {"Album": {"Artist": {}}}
+    :return: (name, field, relationship property, child schema, sub tree)
+    """
+    relationships = sa_inspect(schema.opts.model).relationships
+    for name, sub_tree in iteritems(tree):
+        field = schema._declared_fields.get(name)
+        if not isinstance(field, Related) or field.load_only:
+            raise_args_exception('_include')
+        key = field.attribute or name
+        if key not in relationships:
+            raise_args_exception('_include')
+        yield name, field, relationships[key], field.get_schema_class(schema), sub_tree
+
+
+def get_include_options(schema, tree):
+    """
+    生成关联资源的加载选项, 每个关系使用一次 IN 批量查询
+    :param schema: ModelSchema class
+    :param tree: 路径树
+    :return: list of loader options
+    """
+    options = []
+
+    def walk(current_schema, current_tree, parent):
+        for name, field, prop, child_schema, sub_tree in iter_included_fields(current_schema, current_tree):
+            if prop.lazy == "dynamic":
+                # AppenderQuery 无法预加载
+                continue
+            attr = getattr(prop.parent.class_, prop.key)
+            loader = getattr(orm if parent is None else parent, COLLECTION_LOADER)
+            option = loader(attr)
+            if sub_tree:
+                walk(child_schema, sub_tree, option)
+            else:
+                options.append(option)
+
+    walk(schema, tree, None)
+    return options
+
+
+class IncludeCollector(object):
+    """
+    序列化主资源并收集关联资源
+    """
+
+    def __init__(self, related_kwargs=None):
+        """
+        :param related_kwargs: 如{UserSchema: {"only": ["id", "name"]}}
+        """
+        self.related_kwargs = related_kwargs or {}
+        # {endpoint: {key: resource}}
+        self.included = {}
+
+    def dump(self, schema, obj, tree):
+        """
+        序列化资源, 路径树中的关系替换为关联资源的主键
+        :param schema: ModelSchema class
+        :param obj: sa orm 实例
+        :param tree: 路径树
+        :return:
+        """
+        plan = get_dump_plan(
+            schema, 0, related_kwargs=self.related_kwargs, **self.related_kwargs.get(schema, {})
+        )
+        data = plan.dump(obj)
+        self._add_refs(schema, obj, data, tree)
+        return data
+
+    def _add_refs(self, schema, obj, data, tree):
+        for name, field, prop, child_schema, sub_tree in iter_included_fields(schema, tree):
+            value = getattr(obj, field.attribute or name)
+            key = field.dump_to or name
+            if prop.uselist:
+                data[key] = [self.add(child_schema, item, sub_tree) for item in value]
+            elif value is None:
+                data[key] = None
+            else:
+                data[key] = self.add(child_schema, value, sub_tree)
+
+    def add(self, schema, obj, tree):
+        """
+        添加关联资源, 返回其主键. 复合主键返回列表
+        """
+        from .manager import get_schema_endpoint
+
+        identity = sa_inspect(obj).identity
+        bucket = self.included.setdefault(get_schema_endpoint(schema), {})
+        map_key = ",".join(six.text_type(value) for value in identity)
+        data = bucket.get(map_key)
+        if data is None:
+            data = bucket[map_key] = self.dump(schema, obj, {})
+        # 同一个资源可能从不同的路径引用, 合并各路径需要的关系
+        self._add_refs(schema, obj, data, tree)
+        return identity[0] if len(identity) == 1 else list(identity)
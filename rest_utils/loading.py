@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/20
+Desc    :   根据 _expand, _fields, _except 参数生成查询的预加载(eager loading)选项
+"""
+from marshmallow.compat import iteritems
+from sqlalchemy import orm, func
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm.attributes import set_committed_value, instance_state
+
+from .fields import Related
+from .sa_util import chunks, identity_filter, primary_key_attrs, get_model_info
+from .ma.expand import get_child_expand, has_expanded, is_expanded
+
+# sqlalchemy>=1.2 才支持 selectinload
+COLLECTION_LOADER = "selectinload" if hasattr(orm, "selectinload") else "subqueryload"
+SCALAR_LOADER = "joinedload"
+
+
+def iter_expanded_fields(schema, expand, related_kwargs):
+    """
+    遍历schema序列化时会被展开的 fields.Related 字段
+    :param schema: ModelSchema class
+    :param expand: 当前展开层级或者 ExpandPaths
+    :param related_kwargs: 如{UserSchema: {"exclude": ["id"]}}
+    :return: (name, relationship property, child schema, child expand)
+    """
+    if not has_expanded(expand):
+        return
+    kwargs = related_kwargs.get(schema, {})
+    only = kwargs.get("only")
+    exclude = kwargs.get("exclude") or ()
+    relationships = sa_inspect(schema.opts.model).relationships
+    for name, field in iteritems(schema._declared_fields):
+        if not isinstance(field, Related) or field.load_only:
+            continue
+        if not is_expanded(expand, name):
+            continue
+        if only is not None and name not in only:
+            continue
+        if name in exclude:
+            continue
+        key = field.attribute or name
+        if key not in relationships:
+            continue
+        yield name, relationships[key], field.get_schema_class(schema), get_child_expand(expand, name)
+
+
+def _iter_load_paths(schema, expand, related_kwargs, path, collections=True, schemas=()):
+    """
+    :return: (关系路径, 路径上每个关系的子schema)
+    """
+    for name, prop, child_schema, child_expand in iter_expanded_fields(schema, expand, related_kwargs):
+        if prop.lazy == "dynamic":
+            # AppenderQuery 无法预加载
+            continue
+        if prop.uselist and not collections:
+            continue
+        child_path = path + (prop,)
+        child_schemas = schemas + (child_schema,)
+        is_leaf = True
+        for sub_path in _iter_load_paths(
+                child_schema, child_expand, related_kwargs, child_path, collections, child_schemas):
+            is_leaf = False
+            yield sub_path
+        if is_leaf:
+            yield child_path, child_schemas
+
+
+def get_loader_name(prop):
+    """
+    选择关系的加载方式:
+    一对一/多对一使用 JOIN, 不会使分页的行数翻倍;
+    集合使用 IN 批量查询, 每个关系固定一次查询
+    """
+    return COLLECTION_LOADER if prop.uselist else SCALAR_LOADER
+
+
+def get_loaded_columns(schema, related_kwargs):
+    """
+    _fields/_except 限制了返回字段时, 查询需要加载的列属性.
+    主键和关系使用的本地列总是加载; 返回的字段中有非数据库字段(如 fields.Method)时不限制
+    :param schema: ModelSchema class
+    :param related_kwargs: 如{UserSchema: {"only": ["id", "groups"]}}
+    :return: 列属性名列表, 不需要限制时为None
+    """
+    kwargs = related_kwargs.get(schema)
+    if not kwargs:
+        return None
+    only = kwargs.get("only")
+    exclude = kwargs.get("exclude") or ()
+    if only is None and not exclude:
+        return None
+    mapper = sa_inspect(schema.opts.model)
+    info = get_model_info(schema.opts.model)
+    dropped = set()
+    for name, field in iteritems(schema._declared_fields):
+        key = field.attribute or name
+        if (only is not None and name not in only) or name in exclude:
+            if key in info.column_keys:
+                dropped.add(key)
+        elif not field.load_only and key not in info.column_keys and not isinstance(field, Related):
+            # 无法知道该字段会读取哪些列
+            return None
+    if not dropped:
+        return None
+    keep = set(info.pk_keys)
+    columns = dict((id(column), prop.key) for prop in mapper.column_attrs for column in prop.columns)
+    for prop in mapper.relationships:
+        for column in prop.local_columns:
+            if id(column) in columns:
+                keep.add(columns[id(column)])
+    return [prop.key for prop in mapper.column_attrs if prop.key not in dropped or prop.key in keep]
+
+
+def get_column_options(schema, related_kwargs, entity=None):
+    """
+    只加载需要返回的列, 宽表的大字段(TEXT/BLOB)不会被读取
+    :param schema: ModelSchema class
+    :param related_kwargs: 如{UserSchema: {"only": ["id", "groups"]}}
+    :param entity: 查询的实体, 默认为 schema 的 model
+    :return: list of loader options
+    """
+    keys = get_loaded_columns(schema, related_kwargs or {})
+    if keys is None:
+        return []
+    if entity is None:
+        entity = schema.opts.model
+    return [orm.Load(entity).load_only(*[getattr(entity, key) for key in keys])]
+
+
+def get_load_options(schema, expand, related_kwargs=None, collections=True, entity=None):
+    """
+    生成查询的预加载选项. 每一页的查询次数只与展开的关系数量有关, 与返回条数无关
+    :param schema: ModelSchema class
+    :param expand: 展开层级或者 ExpandPaths
+    :param related_kwargs: 如{UserSchema: {"only": ["id", "groups"]}}
+    :param collections: 是否加载集合. 限制集合条数时由 load_limited_collections 加载
+    :param entity: 查询的实体, 如 aliased(model), 默认为 schema 的 model
+    :return: list of loader options
+    """
+    related_kwargs = related_kwargs or {}
+    options = get_column_options(schema, related_kwargs, entity=entity)
+    # 已经限制过列的关系路径
+    limited = set()
+    for path, schemas in _iter_load_paths(schema, expand, related_kwargs, (), collections):
+        option = None
+        for idx, prop in enumerate(path):
+            owner = entity if option is None and entity is not None else prop.parent.class_
+            attr = getattr(owner, prop.key)
+            loader_name = get_loader_name(prop)
+            if option is None:
+                option = getattr(orm, loader_name)(attr)
+            else:
+                option = getattr(option, loader_name)(attr)
+            if path[:idx + 1] in limited:
+                continue
+            limited.add(path[:idx + 1])
+            keys = get_loaded_columns(schemas[idx], related_kwargs)
+            if keys is not None:
+                options.append(option.load_only(*[getattr(prop.mapper.class_, key) for key in keys]))
+        options.append(option)
+    return options
+
+
+def _unique(objs):
+    seen = set()
+    ret = []
+    for obj in objs:
+        if obj is not None and id(obj) not in seen:
+            seen.add(id(obj))
+            ret.append(obj)
+    return ret
+
+
+def load_limited_collection(session, prop, parents, limit, options=None):
+    """
+    每个父资源最多加载 limit 条子资源. 整批父资源只使用一次 ROW_NUMBER() OVER (PARTITION BY parent) 查询
+    :param session:
+    :param prop: 集合关系(uselist=True)
+    :param parents: 父资源列表, 必须已持久化
+    :param limit: 每个父资源的最大条数
+    :param options: 子资源的预加载选项, 以 entity 参数生成
+    :return: ({parent identity: total count}, children)
+    """
+    parent_mapper = prop.parent
+    child_mapper = prop.mapper
+    parent_alias = orm.aliased(parent_mapper.class_)
+    child_alias = orm.aliased(child_mapper.class_)
+    parent_pks = primary_key_attrs(parent_alias, parent_mapper)
+    child_pks = primary_key_attrs(child_alias, child_mapper)
+
+    identities = [instance_state(parent).identity for parent in parents]
+    counts = {}
+    grouped = {}
+    children = []
+    for chunk in chunks(identities):
+        pk_labels = [column.label("ru_pk%d" % idx) for idx, column in enumerate(parent_pks)]
+        inner = session.query(
+            child_alias,
+            func.row_number().over(partition_by=parent_pks, order_by=child_pks).label("ru_rn"),
+            func.count().over(partition_by=parent_pks).label("ru_cnt"),
+            *pk_labels
+        ).select_from(parent_alias).join(
+            child_alias, getattr(parent_alias, prop.key)
+        ).filter(identity_filter(parent_pks, chunk)).subquery()
+        child_entity = orm.aliased(child_mapper.class_, inner)
+        pk_columns = [inner.c["ru_pk%d" % idx] for idx in range(len(parent_pks))]
+        query = session.query(child_entity, inner.c.ru_rn, inner.c.ru_cnt, *pk_columns).filter(
+            # limit=0 时仍然需要读取一行获得总数
+            inner.c.ru_rn <= max(limit, 1)
+        ).order_by(*(pk_columns + [inner.c.ru_rn]))
+        if options:
+            query = query.options(*options(child_entity))
+        for row in query:
+            child, row_number, count = row[0], row[1], row[2]
+            identity = tuple(row[3:])
+            counts[identity] = count
+            if row_number <= limit:
+                grouped.setdefault(identity, []).append(child)
+                children.append(child)
+
+    for parent, identity in zip(parents, identities):
+        set_committed_value(parent, prop.key, grouped.get(identity, []))
+        counts.setdefault(identity, 0)
+    return counts, children
+
+
+def load_limited_collections(session, schema, objs, expand, related_kwargs=None, limit=None, counts=None):
+    """
+    限制展开的集合条数. 与 get_load_options(collections=False) 配合使用:
+    单个对象的关系由查询预加载, 集合在查询之后按关系批量加载
+    :param session:
+    :param schema: ModelSchema class
+    :param objs: 已查询的资源
+    :param expand: 展开层级或者 ExpandPaths
+    :param related_kwargs:
+    :param limit: 每个集合的最大条数
+    :param counts: 写入每个资源的集合总数 {identity key: {field name: count}}
+    :return:
+    """
+    related_kwargs = related_kwargs or {}
+    # 未持久化的资源没有主键
+    objs = [obj for obj in _unique(objs) if instance_state(obj).identity is not None]
+    if not objs:
+        return
+    for name, prop, child_schema, child_expand in iter_expanded_fields(schema, expand, related_kwargs):
+        if prop.lazy == "dynamic":
+            continue
+        if prop.uselist:
+            def options(entity):
+                return get_load_options(child_schema, child_expand, related_kwargs, collections=False, entity=entity)
+
+            parent_counts, children = load_limited_collection(session, prop, objs, limit, options)
+            if counts is not None:
+                for obj in objs:
+                    state = instance_state(obj)
+                    counts.setdefault(state.key, {})[name] = parent_counts[state.identity]
+        else:
+            children = [getattr(obj, prop.key) for obj in objs]
+        load_limited_collections(session, child_schema, children, child_expand, related_kwargs, limit, counts)
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/28
+Desc    :   关系路径解析. 如 "Album,Album.Artist" 解析为 {"Album": {"Artist": {}}}
+用于 _include 和按关系名称展开的 _expand
+"""
+
+
+def parse_paths(value, tree=None):
+    """
+    解析逗号分隔的关系路径
+    :param value: 如 "Album,Album.Artist,Genre"
+    :param tree: 合并到已有的路径树
+    :return: 如 {"Album": {"Artist": {}}, "Genre": {}}
+    """
+    if tree is None:
+        tree = {}
+    for path in value.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        for name in path.split('.'):
+            assert name, "invalid relationship path: %s" % path
+            node = node.setdefault(name, {})
+    return tree
+
+
+class ExpandPaths(object):
+    """
+    按关系名称展开, 不可变且可哈希, 可以作为序列化计划的缓存key.
+    ExpandPaths.parse("Album.Artist,Genre") 展开 Album, Album.Artist, Genre
+    """
+    __slots__ = ("_children", "_hash")
+
+    def __init__(self, children=None):
+        """
+        :param children: {name: ExpandPaths}
+        """
+        self._children = dict(children or {})
+        self._hash = None
+
+    @classmethod
+    def from_tree(cls, tree):
+        return cls(dict((name, cls.from_tree(sub_tree)) for name, sub_tree in tree.items()))
+
+    @classmethod
+    def parse(cls, value):
+        return cls.from_tree(parse_paths(value))
+
+    def validate(self, schema):
+        """
+        校验每一层路径都是 schema 的关系字段(fields.Related), 否则抛出 _expand 参数错误
+        :param schema: ModelSchema class
+        :return:
+        """
+        from ..fields import Related
+        from ..exp_format import raise_args_exception
+
+        for name, child in self._children.items():
+            field = schema._declared_fields.get(name)
+            if not isinstance(field, Related) or field.load_only:
+                raise_args_exception('_expand')
+            child.validate(field.get_schema_class(schema))
+
+    def get(self, name):
+        """
+        子关系的展开路径, 未指定时不展开
+        """
+        return self._children.get(name, EMPTY_PATHS)
+
+    def __contains__(self, name):
+        return name in self._children
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __eq__(self, other):
+        return isinstance(other, ExpandPaths) and self._children == other._children
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._children.items()))
+        return self._hash
+
+    def __repr__(self):
+        return "ExpandPaths(%r)" % self._children
+
+
+EMPTY_PATHS = ExpandPaths()
+
+
+def is_expanded(expand, name):
+    """
+    关系字段是否展开
+    :param expand: 展开层级(int), None(不限制) 或者 ExpandPaths
+    :param name: 字段名
+    :return:
+    """
+    if expand is None:
+        return True
+    if isinstance(expand, ExpandPaths):
+        return name in expand
+    return expand > 0
+
+
+def has_expanded(expand):
+    """
+    是否有需要展开的关系字段
+    """
+    if isinstance(expand, ExpandPaths):
+        return len(expand) > 0
+    return expand is None or expand > 0
+
+
+def get_child_expand(expand, name=None):
+    """
+    子资源的展开层级
+    :param expand: 展开层级(int), None 或者 ExpandPaths
+    :param name: 关系字段名
+    :return:
+    """
+    if isinstance(expand, ExpandPaths):
+        return expand.get(name)
+    if expand is None:
+        return 0
+    return expand - 1
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/6/22
+Desc    :   ModelSchema 序列化计划(dump plan)
+同一组 (schema, expand, only, exclude, related_kwargs) 只实例化一次schema并编译字段,
+之后每一行数据直接读取属性并调用字段的格式化方法, 不再重复构造schema和走marshmallow的marshal流程.
+"""
+from marshmallow import fields as ma_fields
+from marshmallow.compat import iteritems
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+from marshmallow.exceptions import ValidationError
+from marshmallow.schema import BaseSchema
+from marshmallow.utils import missing as missing_
+from sqlalchemy.orm.attributes import instance_state
+
+from .expand import get_child_expand
+
+# 缓存的计划数量上限, 超过后整体清空(key只与schema和请求参数组合有关, 一般不会触达)
+MAX_PLANS = 1024
+
+# 单次请求中缓存的子资源序列化结果数量上限
+MAX_MEMO_SIZE = 10000
+
+# _expand_limit 限制集合条数时, 返回集合总数的字段名
+COUNTS_KEY = "_counts"
+
+_plans = {}
+
+
+def _unbound(method):
+    return getattr(method, "__func__", method)
+
+
+def _freeze(value):
+    if value is None:
+        return None
+    return tuple(value)
+
+
+def _freeze_related_kwargs(related_kwargs):
+    return frozenset(
+        (schema, _freeze(kwargs.get("only")), _freeze(kwargs.get("exclude")))
+        for schema, kwargs in iteritems(related_kwargs or {})
+    )
+
+
+def is_compilable(schema):
+    """
+    schema是否可以编译成计划. 自定义了dump流程的schema仍然使用marshmallow序列化
+    :param schema: ModelSchema class
+    :return:
+    """
+    from ..schema import ModelSchema
+
+    for tag in (PRE_DUMP, POST_DUMP):
+        for pass_many in (True, False):
+            if schema.__processors__.get((tag, pass_many)):
+                return False
+    if schema.__accessor__ or schema.__error_handler__:
+        return False
+    for name in ("get_attribute", "handle_error"):
+        if _unbound(getattr(schema, name)) is not _unbound(getattr(BaseSchema, name)):
+            return False
+    if _unbound(schema.dump) is not _unbound(ModelSchema.dump):
+        return False
+    return True
+
+
+def _default_getter(field):
+    """
+    字段值不存在时的默认值, default 可以是函数
+    """
+    default = field.default
+    if callable(default):
+        def get_default():
+            return default()
+    else:
+        def get_default():
+            return default
+    return get_default
+
+
+def _compile_field(name, field, accessor):
+    """
+    编译单个字段, 返回 getter(obj)
+    """
+    field_cls = type(field)
+    serialize = _unbound(field_cls.serialize)
+    attribute = field.attribute or name
+    plain = (
+        field._CHECK_ATTRIBUTE and
+        "." not in attribute and
+        _unbound(field_cls.get_value) is _unbound(ma_fields.Field.get_value) and
+        (
+            serialize is _unbound(ma_fields.Field.serialize) or
+            (serialize is _unbound(ma_fields.Number.serialize) and not field.as_string)
+        )
+    )
+    if not plain:
+        def getter(obj, memo):
+            return field.serialize(name, obj, accessor=accessor)
+
+        return getter
+
+    _serialize = field._serialize
+    get_default = _default_getter(field)
+
+    def getter(obj, memo):
+        value = getattr(obj, attribute, missing_)
+        if value is missing_:
+            return get_default()
+        return _serialize(value, name, obj)
+
+    return getter
+
+
+def _compile_related(name, field, schema, expand, related_kwargs):
+    """
+    编译 fields.Related 字段, 子资源使用子级计划序列化
+    """
+    attribute = field.attribute or name
+    child_schema = field.get_schema_class(schema)
+    child_expand = get_child_expand(expand, name)
+    uselist = getattr(schema.opts.model, attribute).property.uselist
+    # 子级计划延迟获取, 避免 'self' 等循环引用时递归编译
+    holder = []
+    get_default = _default_getter(field)
+
+    def getter(obj, memo):
+        if not holder:
+            holder.append(get_dump_plan(
+                child_schema, child_expand, related_kwargs=related_kwargs,
+                **related_kwargs.get(child_schema, {})
+            ))
+        value = getattr(obj, attribute, missing_)
+        if value is missing_:
+            return get_default()
+        if uselist and value is not None:
+            return holder[0].dump_many(value, memo)
+        return holder[0].dump_memoized(value, memo)
+
+    return getter
+
+
+class DumpPlan(object):
+    """
+    编译后的序列化计划, 线程安全, 可以在请求之间共享
+    """
+
+    def __init__(self, schema, expand=0, only=None, exclude=(), related_kwargs=None):
+        self.schema = schema
+        self.expand = expand
+        self.related_kwargs = related_kwargs or {}
+        only, exclude = schema.get_dump_options(expand, only=only, exclude=exclude or ())
+        self.only = only
+        self.exclude = exclude
+        self.compiled = is_compilable(schema)
+        self._none_result = None
+        self.schema_ins = schema(only=only, exclude=exclude, related_kwargs=self.related_kwargs)
+        self.getters = self.compile() if self.compiled else None
+
+    def compile(self):
+        from ..fields import Related
+
+        schema_ins = self.schema_ins
+        prefix = schema_ins.prefix or ""
+        accessor = schema_ins.get_attribute
+        getters = []
+        for name, field in iteritems(schema_ins.fields):
+            if field.load_only:
+                continue
+            if isinstance(field, ma_fields.Nested):
+                # Nested 字段会缓存并修改子schema实例, 不能在线程间共享
+                self.compiled = False
+                return None
+            key = prefix + (field.dump_to or name)
+            if isinstance(field, Related):
+                if _unbound(type(field)._serialize) is not _unbound(Related._serialize):
+                    # 自定义的 Related 依赖schema实例上的展开层级
+                    self.compiled = False
+                    return None
+                getter = _compile_related(name, field, self.schema, self.expand, self.related_kwargs)
+            else:
+                getter = _compile_field(name, field, accessor)
+            getters.append((key, getter))
+        return tuple(getters)
+
+    def _dump_by_schema(self, obj):
+        schema_ins = self.schema(
+            only=self.only, exclude=self.exclude, related_kwargs=self.related_kwargs,
+        )
+        data, errors = schema_ins.dump(obj, expand=self.expand)
+        if errors:
+            raise ValidationError(errors, data=data)
+        return data
+
+    def dump(self, obj, memo=None):
+        """
+        序列化单个对象, 出错时抛出 ValidationError
+        :param obj: sa orm 实例
+        :param memo: DumpMemo, 子资源的序列化结果在同一个memo中复用
+        :return:
+        """
+        if obj is None and self.compiled:
+            # 空的一对一子资源, 结果只与字段默认值有关
+            if self._none_result is None:
+                self._none_result = self._dump_by_schema(None)
+            return self.schema_ins.dict_class(self._none_result)
+        if not self.compiled or obj is None or hasattr(obj, "__getitem__"):
+            # dict 等非orm对象的取值规则较复杂, 交给marshmallow处理
+            return self._dump_by_schema(obj)
+        items = []
+        errors = None
+        for key, getter in self.getters:
+            try:
+                value = getter(obj, memo)
+            except ValidationError as err:
+                if errors is None:
+                    errors = {}
+                errors[key] = err.messages
+                value = err.data or missing_
+            if value is missing_:
+                continue
+            items.append((key, value))
+        if memo is not None and memo.counts:
+            counts = memo.counts.get(instance_state(obj).key)
+            if counts:
+                items.append((COUNTS_KEY, counts))
+        ret = self.schema_ins.dict_class(items)
+        if errors:
+            raise ValidationError(errors, data=ret)
+        return ret
+
+    def dump_memoized(self, obj, memo):
+        """
+        序列化子资源. 同一个请求中被多次引用的对象只序列化一次, 返回同一个结果
+        """
+        if memo is None or obj is None:
+            return self.dump(obj, memo)
+        try:
+            identity_key = instance_state(obj).key
+        except AttributeError:
+            identity_key = None
+        if identity_key is None:
+            # 未持久化的对象
+            return self.dump(obj, memo)
+        # 计划已经包含了展开层级和字段限制
+        key = (self, identity_key)
+        ret = memo.get(key)
+        if ret is None:
+            ret = self.dump(obj, memo)
+            memo.set(key, ret)
+        return ret
+
+    def dump_many(self, objs, memo=None):
+        ret = []
+        errors = {}
+        for idx, obj in enumerate(objs):
+            try:
+                ret.append(self.dump_memoized(obj, memo))
+            except ValidationError as err:
+                errors[idx] = err.messages
+                ret.append(err.data)
+        if errors:
+            raise ValidationError(errors, data=ret)
+        return ret
+
+
+class DumpMemo(object):
+    """
+    单次请求内的子资源序列化结果缓存, 超过上限后不再缓存
+    """
+
+    def __init__(self, maxsize=MAX_MEMO_SIZE):
+        self.maxsize = maxsize
+        self._data = {}
+        # 被限制条数的集合总数 {identity key: {field name: count}}
+        self.counts = {}
+
+    def get(self, key):
+        return self._data.get(key)
+
+    def set(self, key, value):
+        if len(self._data) < self.maxsize:
+            self._data[key] = value
+
+
+def get_dump_plan(schema, expand=0, only=None, exclude=(), related_kwargs=None):
+    """
+    获取缓存的序列化计划
+    :param schema: ModelSchema class
+    :param expand: 展开层级
+    :param only:
+    :param exclude:
+    :param related_kwargs: 如{UserSchema: {"exclude": ["id"]}}
+    :return: DumpPlan
+    """
+    key = (schema, expand, _freeze(only), _freeze(exclude), _freeze_related_kwargs(related_kwargs))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = DumpPlan(schema, expand, only=only, exclude=exclude, related_kwargs=related_kwargs)
+        if len(_plans) >= MAX_PLANS:
+            _plans.clear()
+        _plans[key] = plan
+    return plan
+
+
+def clear_dump_plans():
+    _plans.clear()
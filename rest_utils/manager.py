@@ -10,22 +10,32 @@ Desc    :
 import functools
 import inspect as sys_inspect
 from flask import Flask, Blueprint, jsonify, g, request, Response, current_app, _app_ctx_stack
+from flask import stream_with_context
 from types import ModuleType
 
-from marshmallow.compat import iteritems, itervalues
+from marshmallow.compat import iteritems, itervalues, text_type
 from marshmallow.exceptions import ValidationError
 from sqlalchemy import inspect, orm
 from sqlalchemy.util import IdentitySet
 from sqlalchemy.orm import object_session
 from sqlalchemy.orm import relationship, backref
-from flask.json import _json
-from flask.json import JSONEncoder
+from flask.json import JSONEncoder, dumps as flask_json_dumps
 from sqlalchemy.engine import reflection
 from sqlalchemy.schema import Table
 from sqlalchemy.ext.automap import automap_base
 
 from .utils import jsonres, get_session, get_resource_data
-from .sa_util import get_instance, get_list_attr_query, get_tablename
+from .sa_util import get_instance, get_list_attr_query, get_tablename, InstanceIndex, get_instances_by_identities
+from .sa_util import get_model_info, session_get
+from .cache import model_cache, response_cache, invalidate_models, generations, get_reachable_tables
+from .cache import get_filters_key
+from .loading import get_load_options, get_column_options, load_limited_collections
+from .include import get_include_options, IncludeCollector
+from .bulk import is_bulk_creatable, bulk_create, is_bulk_deletable, delete_identities
+from .bulk import load_update_values, update_by_query, is_directly_updatable, update_one
+from .encoder import DynamicJSONEncoder, get_json_backend
+from .ma.plan import get_dump_plan, DumpMemo
+from .ma.expand import ExpandPaths
 from .decorators import no_cache
 from .error_route import register_err_route
 from .ma.model_registry import get_schemas
@@ -53,6 +63,12 @@ UPDATE_METHODS = frozenset(('PUT', 'PATCH'))
 
 NO_CONTENT = 204
 
+# schema_dump_one 可以使用序列化计划的参数
+PLAN_SCHEMA_KWARGS = frozenset(("session", "only", "exclude", "related_kwargs"))
+
+# 流式返回时每次输出的行数
+STREAM_CHUNK_ROWS = 100
+
 
 def cls_primary_key(model):
     """
@@ -100,26 +116,16 @@ def get_schema_endpoint(schema):
     return _get_schema_endpoint(schema)[0]
 
 
-class DynamicJSONEncoder(_json.JSONEncoder):
-    """ JSON encoder for custom classes:
-        Uses __json__() method if available to prepare the object.
-        Especially useful for SQLAlchemy models
-    """
-    from decimal import Decimal
-
-    def default(self, o):
-        # Custom JSON-encodeable objects
-        if hasattr(o, '__json__'):
-            return o.__json__()
-
-        elif isinstance(o, self.Decimal):
-            return str(o)
-
-        # Default
-        return super(DynamicJSONEncoder, self).default(o)
-
-
 def schema_dump_one(schema, resource, expand=0, **schema_kwargs):
+    if set(schema_kwargs) <= PLAN_SCHEMA_KWARGS:
+        # 序列化与session无关, 使用缓存的序列化计划
+        return get_dump_plan(
+            schema,
+            expand,
+            only=schema_kwargs.get("only"),
+            exclude=schema_kwargs.get("exclude", ()),
+            related_kwargs=schema_kwargs.get("related_kwargs"),
+        ).dump(resource, DumpMemo())
     schema_ins = schema(**schema_kwargs)
     data, errors = schema_ins.dump(resource, expand=expand)
     if errors:
@@ -127,6 +133,37 @@ def schema_dump_one(schema, resource, expand=0, **schema_kwargs):
     return data
 
 
+def iter_json_list(payload, name, rows, dump, batch_size=STREAM_CHUNK_ROWS):
+    """
+    逐行生成列表的json: 先输出payload中的其他字段, 然后逐行输出payload[name]
+    :param payload: 列表返回格式, 如 {"total": 1, "items": []}
+    :param name: 列表字段名
+    :param rows: 资源迭代器
+    :param dump: 序列化方法
+    :param batch_size: 每次输出的行数
+    :return:
+    """
+    dumps = get_api_manager().json_dumps
+
+    envelope = dict(payload)
+    envelope.pop(name, None)
+    head = dumps(envelope)[:-1].rstrip()
+    if envelope:
+        head += b","
+    yield head + dumps(name) + b":["
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(dumps(dump(row)))
+        if len(chunk) >= batch_size:
+            yield (b"" if first else b",") + b",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b"" if first else b",") + b",".join(chunk)
+    yield b"]}"
+
+
 def schema_load(schema, data, many=False, **schema_kwargs):
     schema_ins = schema(**schema_kwargs)
     ins, errors = schema_ins.load(data, many=many)
@@ -171,6 +208,8 @@ class RouteApiView(object):
         self.manager = manager
         self.schema = schema
         self.model = model = schema.opts.model
+        # 主键, 唯一约束等元数据只在注册时计算一次
+        self.model_info = get_model_info(model)
         self.table_name = get_tablename(model)
 
         blueprint_name = "_".join([name for name in [
@@ -193,7 +232,7 @@ class RouteApiView(object):
             if method in current_methods:
                 self.register_uri(method)
             else:
-                self.register_uri(method, lambda o, *args: o.handle_unmatchable)
+                self.register_uri(method, lambda o, *args: o.handle_unmatchable, invalidate=False)
 
     def register_default(self):
         # TODO 不再使用
@@ -224,10 +263,9 @@ class RouteApiView(object):
                 key_field: value
             }
         else:
-            attr = cls_primary_key(self.model)
-            column = getattr(self.model, attr)
+            attr = self.model_info.route_key
             try:
-                value = column.type.python_type(key)
+                value = self.model_info.route_key_type(key)
             except:
                 raise ResourceNotFound(dict(
                     endpoint=self.endpont, key=key
@@ -236,25 +274,80 @@ class RouteApiView(object):
                 attr: value
             }
 
-    def _get_resource(self, key):
+    def _is_directly_updatable(self, key, data):
+        """
+        PATCH 是否可以直接执行 UPDATE: 查找条件是主键或者唯一约束字段, 只能匹配一个资源, 且数据不修改查找字段
+        :param key:
+        :param data: 请求数据
+        :return:
+        """
+        if not is_directly_updatable(self.schema, data):
+            return False
+        key_field_cond = self._key_field_cond(key)
+        return tuple(key_field_cond) in self.model_info.key_plans and set(key_field_cond).isdisjoint(data)
+
+    def _get_resource(self, key, options=None):
         session = get_session()
-        return session.query(self.model).filter_by(**self._key_field_cond(key)).first()
+        key_field_cond = self._key_field_cond(key)
+        route_key = self.model_info.route_key
+        if len(self.model_info.pk_keys) == 1 and list(key_field_cond) == [route_key]:
+            # 按主键查询
+            return self._get_by_identity((key_field_cond[route_key],), options=options)
+        query = session.query(self.model)
+        if options:
+            query = query.options(*options)
+        return query.filter_by(**key_field_cond).first()
+
+    def _get_by_identity(self, identity, options=None):
+        """
+        按主键查询: 二级缓存(cache_ttl), session identity map, 最后查询数据库.
+        写请求中的查询不使用二级缓存, 缓存要在请求结束之后才失效.
+        缓存只保存字段值, 有加载选项(_expand 预加载等)时查询数据库, 避免逐个懒加载子资源
+        :param identity: 主键值 tuple
+        :param options:
+        :return:
+        """
+        session = get_session()
+        ttl = self.schema.opts.cache_ttl
+        if not ttl or request.method not in ("GET", "HEAD"):
+            return session_get(session, self.model, identity, options=options)
+        if not options:
+            resource = model_cache.get(session, self.model, identity)
+            if resource is not None:
+                return resource
+        generation = model_cache.generation(self.model)
+        resource = session_get(session, self.model, identity, options=options)
+        if resource is not None:
+            model_cache.set(resource, ttl, generation)
+        return resource
+
+    def write_view(self, func):
+        """
+        写请求成功之后使相关表的缓存失效
+        :param func:
+        :return:
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            add_padding_callback(invalidate_models, [self.model])  # commit数据库之后调用
+            return func(*args, **kwargs)
+
+        return wrapper
 
     @staticmethod
     def res(data, status_code=200):
-        if isinstance(data, (list, tuple)):
-            res = jsonres(data)
-        else:
-            res = jsonify(data)
+        res = jsonres(data)
         res.status_code = status_code
         return res
 
-    def register_uri(self, http_method, route_get=None):
+    def register_uri(self, http_method, route_get=None, invalidate=True):
         """
         注册路由
         :param endpoint:
         :param http_method:
         :param route_get: 获取路由handler
+        :param invalidate: 写请求成功之后是否使缓存失效
         :return:
         """
         if route_get is None:
@@ -266,8 +359,15 @@ class RouteApiView(object):
         else:
             ms = (http_method.upper(),)
 
+        if http_method == "get" or not invalidate:
+            def wrap(func):
+                return func
+        else:
+            wrap = self.write_view
+
         cls_attr = route_get(self, "%s_%s" % (http_method, "cls"), None)
         if cls_attr:
+            cls_attr = wrap(cls_attr)
             self.blueprint.add_url_rule(
                 "", methods=ms,
                 view_func=cls_attr
@@ -279,6 +379,7 @@ class RouteApiView(object):
 
         one_attr = route_get(self, "%s_%s" % (http_method, "one"), None)
         if one_attr:
+            one_attr = wrap(one_attr)
             self.blueprint.add_url_rule(
                 "/<key>", methods=ms,
                 view_func=one_attr
@@ -286,6 +387,8 @@ class RouteApiView(object):
 
         # 注册子资源链接
         sub_attr = route_get(self, "%s_%s" % (http_method, "attr"), None)
+        if sub_attr:
+            sub_attr = wrap(sub_attr)
         for attr in inspect(self.model).mapper.relationships.keys():
             # @functools.wraps(func)
             # def wrapper(key):
@@ -305,6 +408,72 @@ class RouteApiView(object):
                 endpoint=endpoint
             )
 
+    @classmethod
+    def load_options(cls, schema):
+        """
+        使用flask request 参数生成预加载选项, 避免序列化时逐行懒加载子资源
+        :param schema:
+        :return:
+        """
+        info_args = get_info_args()
+        related_kwargs = get_api_manager().related_kwargs
+        if info_args.include is not None:
+            return get_column_options(schema, related_kwargs) + get_include_options(schema, info_args.include)
+        if isinstance(info_args.expand, ExpandPaths):
+            info_args.expand.validate(schema)
+        return get_load_options(
+            schema,
+            expand=info_args.expand,
+            related_kwargs=related_kwargs,
+            # 限制条数的集合在查询之后由 load_limited_collections 加载
+            collections=info_args.expand_limit is None,
+        )
+
+    @classmethod
+    def limit_collections(cls, schema, resources, memo):
+        """
+        _expand_limit: 限制展开的集合条数, 集合总数写入 memo.counts
+        :param schema:
+        :param resources: 资源列表
+        :param memo: DumpMemo
+        :return:
+        """
+        info_args = get_info_args()
+        if info_args.expand_limit is None:
+            return
+        load_limited_collections(
+            get_session(),
+            schema,
+            resources,
+            info_args.expand,
+            related_kwargs=get_api_manager().related_kwargs,
+            limit=info_args.expand_limit,
+            counts=memo.counts,
+        )
+
+    def stream_enabled(self):
+        """
+        _num=-1 时是否流式返回. _include 需要在列表之后返回关联资源, _expand_limit 需要整页批量加载集合, 不能流式返回
+        :return:
+        """
+        info_args = get_info_args()
+        return self.manager.stream_results and info_args.include is None and info_args.expand_limit is None
+
+    @classmethod
+    def dump_plan(cls, schema):
+        """
+        使用flask request 参数获取缓存的序列化计划
+        :param schema:
+        :return: rest_utils.ma.plan.DumpPlan
+        """
+        related_kwargs = get_api_manager().related_kwargs
+        return get_dump_plan(
+            schema,
+            get_info_args().expand,
+            related_kwargs=related_kwargs,
+            **related_kwargs.get(schema, {})
+        )
+
     @classmethod
     def dump_one(cls, schema, resource):
         """
@@ -313,39 +482,140 @@ class RouteApiView(object):
         :param resource:
         :return:
         """
-        info_args = get_info_args()
+        memo = DumpMemo()
+        cls.limit_collections(schema, [resource], memo)
+        return cls.dump_plan(schema).dump(resource, memo)
 
-        related_kwargs = get_api_manager().related_kwargs
-        current_kwargs = related_kwargs.get(schema, {})
+    @classmethod
+    def dump_list(cls, schema, resources):
+        """
+        使用flask request 参数序列化资源列表
+        :param schema:
+        :param resources:
+        :return: list
+        """
+        memo = DumpMemo()
+        cls.limit_collections(schema, resources, memo)
+        plan = cls.dump_plan(schema)
+        return [plan.dump(resource, memo) for resource in resources]
 
-        return schema_dump_one(
-            session=get_session(),
-            schema=schema,
-            resource=resource,
-            expand=info_args.expand,
-            related_kwargs=related_kwargs,
-            **current_kwargs
+    @classmethod
+    def refresh(cls, schema, resources):
+        """
+        commit之后资源已过期, 使用主键 IN 查询一次刷新全部资源, 避免序列化时逐个查询
+        :param schema:
+        :param resources: 已提交的资源
+        :return: 刷新后的资源列表
+        """
+        identities = [inspect(resource).identity for resource in resources]
+        ret = get_instances_by_identities(
+            get_session(), schema.opts.model, identities, options=cls.load_options(schema)
         )
+        return [resource for resource in ret if resource is not None]
+
+    def dump_written(self, schema, resources):
+        return self.dump_list(schema, self.refresh(schema, resources))
+
+    def dump_written_one(self, schema, resource):
+        ret = self.refresh(schema, [resource])
+        return self.dump_one(schema, ret[0] if ret else resource)
+
+    def page_payload(self, total, result_list):
+        """
+        列表返回格式. 不统计总数时(_count=none)返回has_more, 游标分页时返回next_cursor
+        :param total:
+        :param result_list:
+        :return:
+        """
+        page_args = get_page_args()
+        payload = dict()
+        if total is None:
+            payload["has_more"] = bool(page_args.has_more)
+        else:
+            payload["total"] = total
+        if page_args.cursor_mode:
+            # 游标分页, 最后一页为None
+            payload["next_cursor"] = page_args.next_cursor
+        payload[self.manager.top_level_json_name] = result_list
+        return payload
+
+    def page_response(self, schema, resources, total):
+        """
+        返回列表. 分批读取的结果使用流式返回, 不在内存中生成完整列表
+        :param schema:
+        :param resources:
+        :param total:
+        :return:
+        """
+        include = get_info_args().include
+        if include is not None:
+            collector = IncludeCollector(get_api_manager().related_kwargs)
+            result_list = [collector.dump(schema, resource, include) for resource in resources]
+            payload = self.page_payload(total, result_list)
+            payload[self.manager.included_json_name] = collector.included
+            return self.res(payload, 200)
+
+        plan = self.dump_plan(schema)
+        # 同一个响应中重复引用的子资源只序列化一次
+        memo = DumpMemo()
+        if not get_page_args().streaming:
+            resources = list(resources)
+            self.limit_collections(schema, resources, memo)
+            result_list = [plan.dump(resource, memo) for resource in resources]
+            return self.res(self.page_payload(total, result_list), 200)
+        payload = self.page_payload(total, [])
+        return Response(
+            stream_with_context(iter_json_list(
+                payload, self.manager.top_level_json_name, resources, functools.partial(plan.dump, memo=memo),
+            )),
+            mimetype='application/json',
+        )
+
+    def cached_response(self, view, ttl, ext_filters=()):
+        """
+        缓存查询结果. key 为路径, 查询参数, schema 的 filters 和相关表的版本号
+        :param view: 生成响应的方法
+        :param ttl: 缓存秒数
+        :param ext_filters: schema.opts.filters() 的结果
+        :return:
+        """
+        key = (
+            request.path,
+            tuple(sorted(request.args.items(multi=True))),
+            request.headers.get("X-Requested-With"),
+            get_filters_key(ext_filters),
+            generations.get_many(get_reachable_tables(self.model)),
+        )
+        entry = response_cache.get(key)
+        if entry is None:
+            response = view()
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            entry = response_cache.set(key, response.get_data(), response.mimetype, ttl)
+        accept_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+        return entry.make_response(accept_gzip)
 
     def get_cls(self):
         """
         查询列表
         :return:
         """
+        ttl = self.schema.opts.response_cache_ttl
+        ext_filters = self.schema.opts.filters()
+        if ttl:
+            return self.cached_response(functools.partial(self._get_cls, ext_filters), ttl, ext_filters)
+        return self._get_cls(ext_filters)
+
+    def _get_cls(self, ext_filters):
         resources, total = get_page_args().get(
             self.model,
-            ext_filters=self.schema.opts.filters(),
-        )
-        result_list = []
-        for resource in resources:
-            one_dump = self.dump_one(self.schema, resource)
-            result_list.append(one_dump)
-
-        payload = dict(
-            total=total,
+            ext_filters=ext_filters,
+            options=self.load_options(self.schema),
+            count_strategy=self.schema.opts.count_strategy,
+            count_cache_ttl=self.schema.opts.count_cache_ttl,
+            stream=self.stream_enabled(),
         )
-        payload[self.manager.top_level_json_name] = result_list
-        return self.res(payload, 200)
+        return self.page_response(self.schema, resources, total)
 
     def post_cls(self):
         """
@@ -359,6 +629,10 @@ class RouteApiView(object):
         else:
             many = False
         session = get_session()
+        if many and is_bulk_creatable(self.schema, data):
+            # 整批校验后使用 executemany 写入
+            ins = bulk_create(session, self.schema, data, options=self.load_options(self.schema))
+            return self.res(self.dump_list(self.schema, [item for item in ins if item is not None]), 201)
         ins = schema_load(
             self.schema, data,
             many=many,
@@ -371,13 +645,9 @@ class RouteApiView(object):
             session.add(ins)
         session.commit()
         if many:
-            return self.res([self.dump_one(
-                self.schema, item
-            ) for item in ins], 201)
+            return self.res(self.dump_written(self.schema, ins), 201)
         else:
-            return self.res(self.dump_one(
-                self.schema, ins
-            ), 201)
+            return self.res(self.dump_written_one(self.schema, ins), 201)
 
     def put_cls(self):
         """
@@ -385,6 +655,11 @@ class RouteApiView(object):
         :return:
         """
         data = get_resource_data(request)
+        if request.method == "PATCH" and isinstance(data, dict):
+            filters = get_page_args().get_filters(self.model)
+            if filters:
+                # PATCH /users?name=windpro 按条件修改
+                return self.update_by_filter(data, filters)
         # 支持批量
         if isinstance(data, (list, tuple)):
             many = True
@@ -405,48 +680,104 @@ class RouteApiView(object):
 
         create_count = 0
         for obj in ins_list:
-            if not object_session(obj):
+            obj_session = object_session(obj)
+            if not obj_session:
                 # 创建的
                 session.add(obj)
                 create_count += 1
-            else:
+            elif obj_session is not session:
+                # 批量查询的资源已经在当前session中, 不需要merge
                 session.merge(obj)
         if create_count == len(ins_list):
             # 纯创建的情况，status code为201
             status_code = 201
         session.commit()
         if many:
-            return self.res([self.dump_one(
-                self.schema, item
-            ) for item in ins], status_code)
+            return self.res(self.dump_written(self.schema, ins), status_code)
         else:
-            return self.res(self.dump_one(
-                self.schema, ins
-            ), status_code)
+            return self.res(self.dump_written_one(self.schema, ins), status_code)
+
+    def update_by_filter(self, data, filters):
+        """
+        按查询条件修改, 返回修改的行数. _returning=1 时同时返回修改后的资源
+        :param data: 部分更新的数据
+        :param filters: 查询条件
+        :return:
+        """
+        values = load_update_values(self.schema, data)
+        returning = get_info_args().returning
+        session = get_session()
+        query = session.query(self.model).filter(*(list(filters) + list(self.schema.opts.filters())))
+        count, identities = update_by_query(session, self.schema, query, values, returning=returning)
+        session.commit()
+        payload = {"count": count}
+        if returning:
+            resources = get_instances_by_identities(
+                session, self.model, identities, options=self.load_options(self.schema)
+            )
+            payload[self.manager.top_level_json_name] = self.dump_list(
+                self.schema, [resource for resource in resources if resource is not None]
+            )
+        return self.res(payload)
 
     def delete_cls(self):
+        if not request.get_data():
+            # 没有请求数据时按查询条件删除
+            return self.delete_by_filter()
         raw_data = get_resource_data(request)
         # 支持批量
         if isinstance(raw_data, (list, tuple)):
             data_list = raw_data
         else:
-            data_list = raw_data
+            data_list = [raw_data]
         session = get_session()
+        # 一次查询所有需要删除的资源
+        index = InstanceIndex(session, self.model, data_list)
+        instances = []
         for data in data_list:
-            instance = get_instance(session, self.model, data)
+            instance = index.get(data)
             if not instance:
                 raise ResourceNotFound({
                     "endpoint": self.endpont,
                     "data": data,
                 })
+            instances.append(instance)
+        if is_bulk_deletable(self.schema):
+            identities = list(set(inspect(instance).identity for instance in instances))
+            delete_identities(session, self.model, identities)
+        else:
+            self.delete_instances(session, instances)
+        session.commit()
+        return no_content_response()
+
+    def delete_instances(self, session, instances):
+        for instance in instances:
             instance = self.schema.opts.delete(instance)
             add_padding_callback(self.schema.opts.deleted, instance)
             session.delete(instance)
+
+    def delete_by_filter(self):
+        """
+        按查询条件删除: DELETE /users?name=windpro, 必须指定查询条件
+        :return:
+        """
+        filters = get_page_args().get_filters(self.model)
+        if not filters:
+            raise IllegalRequestData({
+                u"msg": u"按条件删除时必须指定查询条件",
+            })
+        filters.extend(self.schema.opts.filters())
+        session = get_session()
+        query = session.query(self.model).filter(*filters)
+        if is_bulk_deletable(self.schema):
+            query.delete(synchronize_session=False)
+        else:
+            self.delete_instances(session, query.all())
         session.commit()
         return no_content_response()
 
-    def _get_keyfield_instance(self, key):
-        resource = self._get_resource(key)
+    def _get_keyfield_instance(self, key, options=None):
+        resource = self._get_resource(key, options=options)
         if not resource:
             raise ResourceNotFound(dict(
                 endpoint=self.endpont, key=key
@@ -459,9 +790,14 @@ class RouteApiView(object):
         :param key:
         :return:
         """
-        return self.res(self.dump_one(
-            self.schema, self._get_keyfield_instance(key))
-        )
+        resource = self._get_keyfield_instance(key, options=self.load_options(self.schema))
+        include = get_info_args().include
+        if include is not None:
+            collector = IncludeCollector(get_api_manager().related_kwargs)
+            data = collector.dump(self.schema, resource, include)
+            data[self.manager.included_json_name] = collector.included
+            return self.res(data)
+        return self.res(self.dump_one(self.schema, resource))
 
     def post_one(self, key):
         """
@@ -481,9 +817,7 @@ class RouteApiView(object):
         )
         session.add(ins)
         session.commit()
-        return self.res(self.dump_one(
-            self.schema, ins
-        ), 201)
+        return self.res(self.dump_written_one(self.schema, ins), 201)
 
     def put_one(self, key):
         """
@@ -491,7 +825,10 @@ class RouteApiView(object):
         :param key:
         :return:
         """
-        data = dict(get_resource_data(request))
+        data = get_resource_data(request)
+        if request.method == "PATCH" and self._is_directly_updatable(key, data):
+            return self.patch_one(key, data)
+        data = dict(data)
         key_field_cond = self._key_field_cond(key)
         data.update(key_field_cond)
         session = get_session()
@@ -511,9 +848,31 @@ class RouteApiView(object):
             session.merge(ins)
             status_code = 200
         session.commit()
+        return self.res(self.dump_written_one(self.schema, ins), status_code)
+
+    def patch_one(self, key, data):
+        """
+        部分修改单个资源, 不查询旧资源直接执行 UPDATE. 查找条件必须是主键或者唯一约束字段
+        :param key:
+        :param data: 需要修改的字段
+        :return:
+        """
+        values = load_update_values(self.schema, data)
+        session = get_session()
+        count, resource = update_one(session, self.model, self._key_field_filter(key), values)
+        if not count:
+            raise ResourceNotFound(dict(
+                endpoint=self.endpont, key=key
+            ))
+        if resource is not None:
+            # RETURNING 已经返回了修改后的字段
+            data = self.dump_one(self.schema, resource)
+            session.commit()
+            return self.res(data)
+        session.commit()
         return self.res(self.dump_one(
-            self.schema, ins
-        ), status_code)
+            self.schema, self._get_keyfield_instance(key, options=self.load_options(self.schema))
+        ))
 
     def delete_one(self, key):
         resource = self._get_keyfield_instance(key)
@@ -539,17 +898,12 @@ class RouteApiView(object):
                 sub_schema.opts.model,
                 filter_object=filter_obj,
                 ext_filters=sub_schema.opts.filters(),
+                options=self.load_options(sub_schema),
+                count_strategy=sub_schema.opts.count_strategy,
+                count_cache_ttl=sub_schema.opts.count_cache_ttl,
+                stream=self.stream_enabled(),
             )
-            result_list = []
-            for resource in resources:
-                one_dump = self.dump_one(sub_schema, resource)
-                result_list.append(one_dump)
-
-            payload = dict(
-                total=total,
-            )
-            payload[self.manager.top_level_json_name] = result_list
-            return self.res(payload)
+            return self.page_response(sub_schema, resources, total)
         else:
             return self.res(self.dump_one(sub_schema, getattr(resource, attribute)))
 
@@ -614,13 +968,9 @@ class RouteApiView(object):
         session.commit()
 
         if rela_prop.uselist:
-            return self.res([self.dump_one(
-                sub_schema, item
-            ) for item in ins])
+            return self.res(self.dump_written(sub_schema, ins))
         else:
-            return self.res(self.dump_one(
-                sub_schema, ins
-            ))
+            return self.res(self.dump_written_one(sub_schema, ins))
 
     def put_attr(self, key, attribute):
         """
@@ -673,7 +1023,8 @@ class APIManager(object):
     """
     JSON_ENCODER = DynamicJSONEncoder
 
-    def __init__(self, app, db=None, engine=None, prefix="/api", top_level_json_name='items'):
+    def __init__(self, app, db=None, engine=None, prefix="/api", top_level_json_name='items', stream_results=False,
+                 json_backend="auto", included_json_name="included"):
         """
 
         :param app:
@@ -681,6 +1032,11 @@ class APIManager(object):
         :param engine: example: sqlalchemy.create_engine("sqlite://")
         :param prefix:
         :param top_level_json_name:
+        :param stream_results: _num=-1 时分批查询并流式返回列表. 默认关闭: 流式返回中途出错时只能截断已经返回200的响应
+        :param included_json_name: _include 参数返回关联资源的字段名
+        :param json_backend: 返回数据的json编码: "auto", "stdlib", "orjson", "ujson" 或者 rest_utils.encoder.JSONBackend 实例.
+            auto 优先使用已安装的 orjson. 遵循 JSON_AS_ASCII 配置;
+            自定义了 app.json_encoder 时使用flask的json编码
         """
         assert isinstance(app, Flask)
         self.app = app
@@ -717,6 +1073,9 @@ class APIManager(object):
         self.prefix = prefix
         self.key_field_prefix = "@"
         self.top_level_json_name = top_level_json_name
+        self.stream_results = stream_results
+        self.included_json_name = included_json_name
+        self.json_backend = get_json_backend(json_backend, ensure_ascii=app.config.get('JSON_AS_ASCII', True))
 
         # 注册路由的schemas
         self.schemas = {}
@@ -763,6 +1122,22 @@ class APIManager(object):
         setattr(g, cache_name, related_kw)
         return related_kw
 
+    def json_dumps(self, obj, indent=None):
+        """
+        返回数据的json编码(utf-8 bytes). app.json_encoder 被自定义时使用flask的编码, 否则使用 json_backend.
+        与flask一致, JSON_SORT_KEYS 为真时按key排序
+        :param obj:
+        :param indent:
+        :return:
+        """
+        json_encoder = getattr(current_app, "json_encoder", self.JSON_ENCODER)
+        if json_encoder is not self.JSON_ENCODER:
+            ret = flask_json_dumps(obj, indent=indent)
+            if isinstance(ret, text_type):
+                ret = ret.encode("utf-8")
+            return ret
+        return self.json_backend.dumps(obj, indent=indent, sort_keys=current_app.config["JSON_SORT_KEYS"])
+
     def get_cls(self, collection_name):
         self.schemas.get(collection_name)
 
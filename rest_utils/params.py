@@ -12,14 +12,37 @@ import logging
 
 from flask import g, current_app, request
 from sqlalchemy import String
-from sqlalchemy import asc, desc, or_
+from sqlalchemy import asc, desc, or_, func
 from sqlalchemy import inspect as sqla_inspect
+from sqlalchemy.orm import aliased
 from collections import OrderedDict
 import inspect
 
 from .exception import RestException
 from .exp_format import raise_args_exception
-from .utils import get_session, get_api_manager
+from .utils import get_session, get_api_manager, LRUCache
+from .cursor import encode_cursor, decode_cursor, keyset_filter, check_cursor_values
+from .ma.expand import parse_paths, ExpandPaths
+from .cache import generations, get_related_tables
+from .where import split_operator, parse_operator_value, operator_filter, related_filter, compile_where
+
+# 列表总数统计方式
+COUNT_EXACT = "exact"  # SELECT COUNT(*) 精确统计
+COUNT_WINDOW = "window"  # 查询页数据时同时使用 COUNT(*) OVER() 统计, 需要数据库支持窗口函数
+COUNT_ESTIMATE = "estimate"  # 使用执行计划估算(postgresql, mysql), 其他数据库精确统计
+COUNT_CACHED = "cached"  # 相同查询条件在count_cache_ttl秒内复用统计结果
+COUNT_NONE = "none"  # 不统计, 返回has_more
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_WINDOW, COUNT_ESTIMATE, COUNT_CACHED, COUNT_NONE)
+
+# COUNT_CACHED 默认缓存秒数
+COUNT_CACHE_TTL = 10
+# 估算值小于该值时改为精确统计, 小结果集的估算误差较大
+ESTIMATE_EXACT_THRESHOLD = 1000
+
+_count_cache = LRUCache(maxsize=1024)
+
+# 流式返回时每批从数据库读取的行数
+STREAM_BATCH_SIZE = 1000
 
 
 def process_args_exception(func):
@@ -45,6 +68,13 @@ class BaseArgs(object):
         '_expand',
         '_fields',
         '_match',
+        '_count',
+        '_cursor',
+        '_after',
+        '_include',
+        '_expand_limit',
+        '_returning',
+        '_where',
     ]
 
     # @process_args_exception
@@ -78,9 +108,24 @@ class PageArgs(BaseArgs):
         self.sort = None
         self.direction = asc
         self.order_list = []
+        # 按关系字段排序时的外连接
+        self.order_joins = []
         self.array_field = OrderedDict()
         self.equal_field = OrderedDict()
         self.like_field = OrderedDict()
+        # {字段: [(操作符, 值), ...]}, 同一个字段可以有多个比较条件
+        self.operator_field = OrderedDict()
+        # _where 表达式
+        self.where = None
+        self.count = None
+        self.has_more = None
+        # 游标分页: _cursor 为空时返回第一页, 之后传入上一页返回的 next_cursor
+        self.cursor_mode = False
+        self.cursor_values = None
+        self.cursor_order = None
+        self.next_cursor = None
+        # 是否分批读取全部结果
+        self.streaming = False
         self.init()
 
     def set_page(self, value):
@@ -114,9 +159,35 @@ class PageArgs(BaseArgs):
     def set_match(self, value):
         pass
 
+    def set_count(self, value):
+        assert value in COUNT_STRATEGIES
+        self.count = value
+
+    def set_cursor(self, value):
+        self.cursor_mode = True
+        if not value:
+            return
+        try:
+            self.cursor_values, self.cursor_order = decode_cursor(value)
+        except Exception:
+            raise_args_exception('_cursor')
+
+    def set_after(self, value):
+        # _cursor 的别名
+        self.set_cursor(value)
+
+    def set_operator(self, field, op, value):
+        self.operator_field.setdefault(field, []).append((op, parse_operator_value(op, value)))
+
+    def set_where(self, value):
+        self.where = value
+
     def other_set(self, key, value):
         super(PageArgs, self).other_set(key, value)
-        if value.startswith('%') or value.endswith('%'):
+        field, op = split_operator(key)
+        if op is not None and not field.startswith('_'):
+            self.set_operator(field, op, value)
+        elif value.startswith('%') or value.endswith('%'):
             self.like_field[key] = value
         elif not key.startswith('_') and key.endswith('[]'):
             # 列表查找,跳过_开头字段
@@ -131,9 +202,14 @@ class PageArgs(BaseArgs):
             self.order_list.insert(0, (self.sort, self.direction))
 
     # @process_args_exception
-    def get_filters(self, cls):
+    def get_filters(self, cls, joins=None):
         """
         Parse search fields and values to filters.
+        :param cls:
+        :param joins: 传入列表时, 一对一/多对一子资源的条件使用连接, 需要的连接添加到该列表;
+                      默认使用 EXISTS 子查询, 用于不能连接的 UPDATE/DELETE 语句.
+                      集合子资源的条件使用半连接子查询
+        :return:
         """
         from .exp_format import raise_args_exception
 
@@ -142,47 +218,69 @@ class PageArgs(BaseArgs):
         all_field_items = list(self.array_field.items()) + \
                           list(self.equal_field.items()) + \
                           list(self.like_field.items())
+        # {关系名: 别名}, 同一个关系只连接一次
+        aliases = {}
+
+        def get_child_entity(key):
+            father_field, child_field = key.split(".", 1)
+            if father_field not in relationships:
+                raise_args_exception(key)
+            prop = relationships[father_field]
+            child_cls = prop.mapper.class_
+            if child_field != '_match' and not hasattr(child_cls, child_field):
+                raise_args_exception(key)
+            if joins is None or prop.uselist:
+                return prop, child_cls, child_field
+            alias = aliases.get(father_field)
+            if alias is None:
+                alias = aliases[father_field] = aliased(child_cls)
+                joins.append(getattr(cls, father_field).of_type(alias))
+            return prop, alias, child_field
+
+        def add_related_filters(prop, conds):
+            if joins is None or prop.uselist:
+                # 同一个子资源满足所有条件
+                filters.append(related_filter(cls, prop, conds))
+            else:
+                filters.extend(conds)
 
-        for key, value in all_field_items:
+        for key, operators in self.operator_field.items():
             if '.' in key:
-                # set children attribute filters
-                father_field, child_field = key.split(".", 1)
-
-                if father_field not in relationships:
+                prop, entity, child_field = get_child_entity(key)
+                column = getattr(entity, child_field)
+                add_related_filters(prop, [operator_filter(column, op, value) for op, value in operators])
+            else:
+                if not hasattr(cls, key):
                     raise_args_exception(key)
+                column = getattr(cls, key)
+                filters.extend(operator_filter(column, op, value) for op, value in operators)
 
-                child_cls = relationships[father_field].mapper.class_
+        for key, value in all_field_items:
+            if '.' in key:
+                # set children attribute filters
+                prop, entity, child_field = get_child_entity(key)
                 if child_field == '_match':
                     # set children _match filters
-                    fc = self._get_match_filter(child_cls, value)
+                    fc = self._get_match_filter(prop.mapper.class_, value, entity=entity)
                 elif key in self.array_field:
-                    fc = getattr(child_cls, child_field).in_(value)
+                    fc = getattr(entity, child_field).in_(value)
                 elif key in self.like_field:
-                    fc = getattr(child_cls, child_field).like(value, escape='/')
+                    fc = getattr(entity, child_field).like(value, escape='/')
                 else:
-                    fc = getattr(child_cls, child_field) == value
-                    # 这里到底是子资源过滤还是条件过滤
-                    if not relationships[father_field].uselist:
-                        # uselist = false
-                        obj = get_session().query(child_cls).filter(fc).first()
-                        _filter = getattr(cls, father_field) == obj
-                        filters.append(_filter)
-                        continue
-                if relationships[father_field].uselist:
-                    _filter = getattr(cls, father_field).any(fc)
-                else:
-                    _filter = getattr(cls, father_field).has(fc)
-            else:
-                # set attribute filters
-                if not hasattr(cls, key):
-                    raise_args_exception(key)
+                    fc = getattr(entity, child_field) == value
+                add_related_filters(prop, [fc])
+                continue
 
-                if key in self.array_field:
-                    _filter = getattr(cls, key).in_(value)
-                elif key in self.like_field:
-                    _filter = getattr(cls, key).like(value, escape='/')
-                else:
-                    _filter = getattr(cls, key) == value
+            # set attribute filters
+            if not hasattr(cls, key):
+                raise_args_exception(key)
+
+            if key in self.array_field:
+                _filter = getattr(cls, key).in_(value)
+            elif key in self.like_field:
+                _filter = getattr(cls, key).like(value, escape='/')
+            else:
+                _filter = getattr(cls, key) == value
             filters.append(_filter)
 
         # set match filters
@@ -190,25 +288,30 @@ class PageArgs(BaseArgs):
         match_keywords = args.get('_match')
         if match_keywords:
             filters.append(self._get_match_filter(cls, match_keywords))
+        if self.where:
+            filters.append(compile_where(cls, self.where))
         return filters
 
     @staticmethod
-    def _get_match_filter(cls, match_keywords):
+    def _get_match_filter(cls, match_keywords, entity=None):
         """
             Returns a search match filter
             Fields to be searched defines in model.__match_fields__
             Keyword should be specified with '%' as mysql 'like' conditions.
+            entity: 查询使用的实体, 如连接时的别名, 默认为cls
         """
         from .ma.model_registry import get_schemas
+        if entity is None:
+            entity = cls
         match_fields = set()
         for schema in get_schemas(cls):
             if schema.opts.match_fields:
                 match_fields.update(schema.opts.match_fields)
         match_filters = []
         for field in match_fields:
-            column = getattr(cls, field)
             if not hasattr(cls, field):
                 continue
+            column = getattr(entity, field)
             if not isinstance(column.type, String):
                 continue
             for match_keyword in match_keywords.split(','):
@@ -221,26 +324,153 @@ class PageArgs(BaseArgs):
         return or_(*match_filters)
 
     def get_order_list(self, cls):
+        """
+        排序条件. 关系路径(如 Album.Artist.Name)需要的外连接保存在 self.order_joins
+        :param cls:
+        :return:
+        """
         from .exp_format import raise_args_exception
 
-        try:
-            return [direction(getattr(cls, field)) for field, direction in self.order_list]
-        except:
-            if field == self.sort:
-                key = '_sort'
-            else:
-                key = '_orders'
-            raise_args_exception(key)
+        # {关系路径: alias}
+        aliases = {}
+        self.order_joins = []
+        order_list = []
+        for field, direction in self.order_list:
+            try:
+                order_list.append(direction(self._get_order_column(cls, field, aliases)))
+            except Exception:
+                if field == self.sort:
+                    key = '_sort'
+                else:
+                    key = '_orders'
+                raise_args_exception(key)
+        return order_list
 
-    def get(self, cls, ext_filters=[], filter_object=None):
-        filters = self.get_filters(cls)
+    def _get_order_column(self, cls, field, aliases):
+        """
+        排序字段. 经过的一对一/多对一关系使用外连接, 同一路径只连接一次, 每个路径使用单独的别名
+        """
+        names = field.split('.')
+        entity = cls
+        for idx, name in enumerate(names[:-1]):
+            prop = sqla_inspect(entity).mapper.relationships[name]
+            # 集合关系会使结果行重复
+            assert not prop.uselist, "can not sort by collection: %s" % field
+            path = tuple(names[:idx + 1])
+            alias = aliases.get(path)
+            if alias is None:
+                alias = aliases[path] = aliased(prop.mapper.class_)
+                self.order_joins.append(getattr(entity, name).of_type(alias))
+            entity = alias
+        return getattr(entity, names[-1])
+
+    def get(self, cls, ext_filters=[], filter_object=None, options=None,
+            count_strategy=COUNT_EXACT, count_cache_ttl=COUNT_CACHE_TTL, stream=False):
+        """
+        :param cls: sqlalchemy model
+        :param ext_filters: 额外的查询条件
+        :param filter_object: 查询对象, 默认为 session.query(cls)
+        :param options: 预加载等查询选项, 在统计总数之后添加
+        :param count_strategy: 默认的统计方式, 可以被_count参数覆盖. 见 COUNT_STRATEGIES
+        :param count_cache_ttl: COUNT_CACHED 的缓存秒数
+        :param stream: _num=-1 时分批读取结果, 见 self.streaming
+        :return: (resources, total). COUNT_NONE 时total为None, 是否有下一页见self.has_more
+        """
+        joins = []
+        filters = self.get_filters(cls, joins=joins)
         filters.extend(ext_filters)
         order_list = self.get_order_list(cls)
         if filter_object is None:
             filter_object = get_session().query(cls)
+        for join in joins:
+            filter_object = filter_object.join(join)
         resources = filter_object.filter(*filters)
-        total = resources.count()
 
+        strategy = self.count or count_strategy or COUNT_EXACT
+        if stream and self.num == -1 and not self.cursor_mode:
+            self.streaming = True
+            if strategy == COUNT_WINDOW:
+                strategy = COUNT_EXACT
+            total = self._count(cls, resources, strategy, count_cache_ttl)
+            if total is None:
+                self.has_more = False
+            return stream_query(self._paginate(resources, order_list, options), options), total
+        if self.cursor_mode:
+            if strategy == COUNT_WINDOW:
+                # 窗口函数只能统计游标之后的数据
+                strategy = COUNT_EXACT
+            total = self._count(cls, resources, strategy, count_cache_ttl)
+            return self._get_by_cursor(cls, resources, options), total
+        if strategy == COUNT_WINDOW:
+            return self._get_with_window_count(resources, order_list, options)
+        if strategy == COUNT_NONE:
+            return self._get_with_has_more(resources, order_list, options), None
+        total = self._count(cls, resources, strategy, count_cache_ttl)
+        return self._paginate(resources, order_list, options), total
+
+    @staticmethod
+    def _count(model, resources, strategy, count_cache_ttl):
+        if strategy == COUNT_NONE:
+            return None
+        if strategy == COUNT_ESTIMATE:
+            return estimate_count(resources, model)
+        if strategy == COUNT_CACHED:
+            return cached_count(resources, model, count_cache_ttl)
+        return resources.count()
+
+    def get_keyset(self, cls):
+        """
+        游标分页的排序字段: _sort/_orders 之后使用主键保证顺序唯一
+        :param cls:
+        :return: [(attr, direction), ...]
+        """
+        from .exp_format import raise_args_exception
+
+        keyset = list(self.order_list)
+        if self.order_joins:
+            # 游标只能保存当前资源的字段值
+            raise_args_exception('_cursor')
+        attrs = set(field for field, _ in keyset)
+        mapper = sqla_inspect(cls).mapper
+        for column in mapper.primary_key:
+            key = mapper.get_property_by_column(column).key
+            if key not in attrs:
+                keyset.append((key, asc))
+        return keyset
+
+    def _get_by_cursor(self, cls, resources, options):
+        keyset = self.get_keyset(cls)
+        order_key = [[attr, 'desc' if direction is desc else 'asc'] for attr, direction in keyset]
+        columns = [getattr(cls, attr) for attr, _ in keyset]
+        directions = [direction for _, direction in keyset]
+        if self.cursor_values is not None:
+            if self.cursor_order != order_key or not check_cursor_values(columns, self.cursor_values):
+                # 排序条件与生成游标时不一致, 或者游标值被篡改
+                raise_args_exception('_cursor')
+            resources = resources.filter(keyset_filter(columns, directions, self.cursor_values))
+        if options:
+            resources = resources.options(*options)
+        resources = resources.order_by(*[direction(column) for column, direction in zip(columns, directions)])
+        if self.num in (None, -1):
+            self.has_more = False
+            return resources.all()
+        rows = resources.limit(self.num + 1).all()
+        self.has_more = len(rows) > self.num
+        rows = rows[:self.num]
+        if self.has_more:
+            last = rows[-1]
+            self.next_cursor = encode_cursor([getattr(last, attr) for attr, _ in keyset], order_key)
+        return rows
+
+    def _paginate(self, resources, order_list, options, extra=0):
+        """
+        添加查询选项、排序和分页
+        :param extra: 额外多查询的条数
+        """
+        if options:
+            resources = resources.options(*options)
+        for join in self.order_joins:
+            resources = resources.outerjoin(join)
         if self.order_list:
             resources = resources.order_by(*order_list)
         if self.num == -1:
@@ -249,8 +479,110 @@ class PageArgs(BaseArgs):
         elif self.page is not None and self.num is not None:
             # 分页
             offset = (self.page - 1) * self.num
-            resources = resources.offset(offset).limit(self.num)
-        return resources, total
+            resources = resources.offset(offset).limit(self.num + extra)
+        return resources
+
+    def _get_with_window_count(self, resources, order_list, options):
+        rows = self._paginate(resources.add_columns(func.count().over()), order_list, options).all()
+        if rows:
+            return [row[0] for row in rows], rows[0][-1]
+        if self.page > 1 and self.num not in (None, -1):
+            # 超出最后一页时窗口函数没有结果, 只能重新统计
+            return [], resources.count()
+        return [], 0
+
+    def _get_with_has_more(self, resources, order_list, options):
+        if self.num in (None, -1):
+            # 不分页, 仍然需要排序和预加载
+            self.has_more = False
+            return self._paginate(resources, order_list, options).all()
+        rows = self._paginate(resources, order_list, options, extra=1).all()
+        self.has_more = len(rows) > self.num
+        return rows[:self.num]
+
+
+def stream_query(query, options=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    分批读取查询结果, 内存占用与总行数无关
+    :param query:
+    :param options: 查询使用的预加载选项
+    :param batch_size:
+    :return:
+    """
+    from .loading import COLLECTION_LOADER
+
+    if options and COLLECTION_LOADER != "selectinload":
+        # subqueryload 不支持 yield_per
+        return query
+    return query.yield_per(batch_size).execution_options(stream_results=True)
+
+
+def _get_statement(query, model):
+    """
+    编译查询语句, 返回 (connection, sql, params)
+    """
+    connection = query.session.connection(mapper=sqla_inspect(model))
+    compiled = query.statement.compile(dialect=connection.dialect)
+    return connection, str(compiled), compiled.params
+
+
+def _explain_rows(connection, sql, params):
+    """
+    读取执行计划中的预估行数, 不支持的数据库返回None
+    """
+    # sqlalchemy>=1.4 使用 exec_driver_sql 执行原生sql
+    execute = getattr(connection, "exec_driver_sql", connection.execute)
+    dialect_name = connection.dialect.name
+    if dialect_name == "postgresql":
+        plan = execute("EXPLAIN (FORMAT JSON) " + sql, params).scalar()
+        if not isinstance(plan, list):
+            import json
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    if dialect_name == "mysql":
+        row = execute("EXPLAIN " + sql, params).first()
+        if row is None:
+            return 0
+        row = dict(zip(row.keys(), row))
+        filtered = row.get("filtered") or 100
+        return int((row.get("rows") or 0) * filtered / 100)
+    return None
+
+
+def estimate_count(query, model):
+    """
+    使用执行计划估算总数, 估算值较小或者数据库不支持时精确统计
+    :param query:
+    :param model: 查询的 sa orm model
+    :return:
+    """
+    connection, sql, params = _get_statement(query, model)
+    try:
+        total = _explain_rows(connection, sql, params)
+    except Exception as e:
+        logging.warning("estimate count failed: %s", e)
+        total = None
+    if total is None or total < ESTIMATE_EXACT_THRESHOLD:
+        return query.count()
+    return total
+
+
+def cached_count(query, model, ttl=COUNT_CACHE_TTL):
+    """
+    统计总数并缓存, 缓存以查询语句, 参数和相关表的版本号为key. 写请求成功后旧的统计结果不再使用
+    :param query:
+    :param model: 查询的 sa orm model
+    :param ttl: 缓存秒数
+    :return:
+    """
+    connection, sql, params = _get_statement(query, model)
+    generation = generations.get_many(get_related_tables(model))
+    key = (str(connection.engine.url), sql, repr(sorted(params.items())), generation)
+    total = _count_cache.get(key)
+    if total is None:
+        total = query.count()
+        _count_cache.set(key, total, ttl=COUNT_CACHE_TTL if ttl is None else ttl)
+    return total
 
 
 class InfoArgs(BaseArgs):
@@ -258,9 +590,19 @@ class InfoArgs(BaseArgs):
         self.expand = 0
         self.fields = {}
         self.except_ = {}
+        # _include 关系路径树, 如 {"Album": {"Artist": {}}}
+        self.include = None
+        # 展开的集合最多返回的条数
+        self.expand_limit = None
+        # 按条件修改时是否返回修改后的资源
+        self.returning = False
         self.init()
 
     def set_expand(self, value):
+        if not value.lstrip('-').isdigit():
+            # 按关系名称展开, 如 Album.Artist,Genre
+            self.expand = ExpandPaths.parse(value)
+            return
         self.expand = int(value)
         assert 0 <= self.expand <= 10, "_expand params must [0,10]"
 
@@ -279,6 +621,17 @@ class InfoArgs(BaseArgs):
             fields = [item for item in fields_str.split(',')]
             result[endpoint] = fields
 
+    def set_expand_limit(self, value):
+        self.expand_limit = int(value)
+        assert self.expand_limit >= 0
+
+    def set_returning(self, value):
+        assert value in ('0', '1', 'false', 'true')
+        self.returning = value in ('1', 'true')
+
+    def set_include(self, value):
+        self.include = parse_paths(value, self.include)
+
     def set_fields(self, value):
         self.__set_field_format_dict(self.fields, value)
 
@@ -7,14 +7,22 @@ E-mail  :   windprog@gmail.com
 Date    :   17/11/14
 Desc    :   
 """
+import decimal
+
+import six
 from sqlalchemy import inspect
 from flask import g, current_app
 from sqlalchemy import inspect
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, and_, or_
 from sqlalchemy.orm import object_session, object_mapper, properties
 from sqlalchemy import inspect as sa_inspect
 from .utils import get_session, get_class
 
+# 按主键 IN 查询时每批的数量
+IN_CHUNK_SIZE = 500
+# 查找已存在资源时字符串值需要转换的字段类型
+NUMBER_TYPES = frozenset(six.integer_types + (float, decimal.Decimal))
+
 
 def get_primary_keys(model):
     """Get primary key properties for a SQLAlchemy model.
@@ -37,64 +45,241 @@ def get_unique_keys_list(model):
     return ret
 
 
+def chunks(items, size=IN_CHUNK_SIZE):
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def identity_filter(columns, identities):
+    """
+    主键等于 identities 中任意一个的条件
+    :param columns: 主键字段
+    :param identities: 主键值 tuple 列表
+    :return:
+    """
+    if len(columns) == 1:
+        return columns[0].in_([identity[0] for identity in identities])
+    # sqlite 等数据库不支持 (a, b) IN ((1, 2), ...)
+    return or_(*[
+        and_(*[column == value for column, value in zip(columns, identity)])
+        for identity in identities
+    ])
+
+
+def primary_key_attrs(entity, mapper):
+    return [getattr(entity, mapper.get_property_by_column(column).key) for column in mapper.primary_key]
+
+
+def session_get(session, model, identity, options=None):
+    """
+    按主键查询, 优先使用session的identity map
+    :param session:
+    :param model: sa orm model
+    :param identity: 主键值 tuple
+    :param options: 预加载选项
+    :return:
+    """
+    if hasattr(session, "get"):
+        # sqlalchemy>=1.4
+        return session.get(model, identity, options=options)
+    query = session.query(model)
+    if options:
+        query = query.options(*options)
+    return query.get(identity)
+
+
+def get_instances_by_identities(session, model, identities, options=None):
+    """
+    按主键批量查询, 每批使用一次 IN 查询
+    :param session:
+    :param model: sa orm model
+    :param identities: 主键值 tuple 列表
+    :param options: 预加载选项
+    :return: 与 identities 顺序一致的实例列表, 不存在的主键为None
+    """
+    mapper = inspect(model)
+    columns = primary_key_attrs(model, mapper)
+    found = {}
+    for chunk in chunks(identities):
+        query = session.query(model).filter(identity_filter(columns, chunk))
+        if options:
+            query = query.options(*options)
+        for instance in query:
+            found[inspect(instance).identity] = instance
+    return [found.get(tuple(identity)) for identity in identities]
+
+
+class ModelInfo(object):
+    """
+    sa orm model 的主键, 唯一约束, 路由主键类型和关系的关联字段. 注册model时计算一次, 之后只需要字典查找
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.primary_keys = get_primary_keys(model)
+        self.pk_keys = tuple(prop.key for prop in self.primary_keys)
+        # 查找已存在资源时使用的字段组合: 主键, 然后是各个唯一约束
+        self.key_plans = [self.pk_keys] + [
+            tuple(column.key for column in columns) for columns in get_unique_keys_list(model)
+        ]
+        self.column_keys = frozenset(inspect(model).column_attrs.keys())
+        # /users/<key> 使用的主键和类型转换方法
+        column = inspect(model).local_table.primary_key.columns.values()[0]
+        self.route_key = column.name
+        try:
+            self.route_key_type = column.type.python_type
+        except NotImplementedError:
+            self.route_key_type = None
+        # {relationship key: [(father key, child key)]}
+        self._join_pairs = {}
+
+    def match_key_plan(self, data):
+        for keys in self.key_plans:
+            if all(key in data for key in keys):
+                return keys
+        return None
+
+    def get_join_pairs(self, father_attr):
+        """
+        关系的关联字段
+        :param father_attr: 本model的关系属性, 如 User.groups
+        :return: [(father key, child key)]
+        """
+        pairs = self._join_pairs.get(father_attr.key)
+        if pairs is None:
+            pairs = self._join_pairs[father_attr.key] = self._build_join_pairs(father_attr)
+        return pairs
+
+    def _build_join_pairs(self, father_attr):
+        # m = m.data_bindings.parent.class_
+        # m.data_bindings.expression.clauses[0].left.table == sa_inspect(m).tables[0]
+        # query_condition.attr.parent_token.primaryjoin.clauses
+        from sqlalchemy.sql.elements import BinaryExpression
+
+        father_table = inspect(self.model).tables[0]
+        clauses = (
+            [father_attr.expression]
+            if isinstance(father_attr.expression, BinaryExpression) else
+            father_attr.expression.clauses
+        )
+        pairs = []
+        for be in clauses:
+            if be.left.table == father_table:
+                pairs.append((be.left.key, be.right.key))
+            elif be.right.table == father_table:
+                pairs.append((be.right.key, be.left.key))
+            # 多对多关系会捕获无效条件
+            # father_attr.prop.direction: sqlalchemy.util.langhelpers.symbol
+        return pairs
+
+
+# {model: ModelInfo}
+_model_infos = {}
+
+
+def get_model_info(model):
+    info = _model_infos.get(model)
+    if info is None:
+        info = _model_infos[model] = ModelInfo(model)
+    return info
+
+
+class InstanceIndex(object):
+    """
+    批量查询已存在的资源. 与 get_instance 的查找规则一致, 每种字段组合只使用一次 IN 查询.
+    数据库的比较规则(类型转换, 不区分大小写的排序规则等)与python不同, IN 查询返回了没有直接匹配的资源时,
+    未命中的数据再使用 get_instance 查找
+    """
+
+    def __init__(self, session, model, data_list):
+        """
+        :param session:
+        :param model: sa orm model
+        :param data_list: 反序列化后的数据列表
+        """
+        self.session = session
+        self.model = model
+        self.info = get_model_info(model)
+        self._types = {}
+        # {keys: {values: instance}}
+        self._index = {}
+        # 有没有直接匹配的资源的字段组合
+        self._unmatched = set()
+        values = {}
+        for data in data_list:
+            keys = self.info.match_key_plan(data)
+            if keys is None:
+                continue
+            value = self._get_value(keys, data)
+            if None in value:
+                # NULL 不会与已存在的资源冲突
+                continue
+            values.setdefault(keys, set()).add(value)
+        for keys, plan_values in values.items():
+            index = self._index[keys] = {}
+            columns = [getattr(model, key) for key in keys]
+            for chunk in chunks(list(plan_values)):
+                for instance in session.query(model).filter(identity_filter(columns, chunk)):
+                    index[tuple(getattr(instance, key) for key in keys)] = instance
+            if not plan_values.issuperset(index):
+                self._unmatched.add(keys)
+
+    def _coerce(self, key, value):
+        """
+        数字字段的字符串值转换为字段类型, 如 "5" 与 5 一致
+        """
+        python_type = self._types.get(key)
+        if python_type is None:
+            try:
+                python_type = getattr(self.model, key).type.python_type
+            except NotImplementedError:
+                python_type = object
+            self._types[key] = python_type
+        if isinstance(value, six.string_types) and python_type in NUMBER_TYPES:
+            try:
+                return python_type(value)
+            except (ValueError, ArithmeticError):
+                return value
+        return value
+
+    def _get_value(self, keys, data):
+        return tuple(self._coerce(key, data[key]) for key in keys)
+
+    def get(self, data):
+        keys = self.info.match_key_plan(data)
+        if keys is None:
+            return None
+        value = self._get_value(keys, data)
+        index = self._index.get(keys, {})
+        if value in index:
+            return index[value]
+        if keys not in self._unmatched:
+            # IN 查询返回的资源都已直接匹配, 不存在
+            return None
+        instance = index[value] = _get_instance_by_keys(self.session, self.model, data)
+        return instance
+
+
+def _get_instance_by_keys(session, model, data):
+    keys = get_model_info(model).match_key_plan(data)
+    if keys is None:
+        return None
+    # field all exists
+    return session.query(model).filter_by(**dict((key, data[key]) for key in keys)).first()
+
+
 def get_instance(session, model, data):
     """Retrieve an existing record by primary key(s) or unique key(s)."""
-    unique_list = [
-        get_primary_keys(model)
-    ]
-    unique_list.extend(get_unique_keys_list(model))
-    for props in unique_list:
-        keys = set(prop.key for prop in props)
-        cond = {
-            key: data[key]
-            for key in keys if key in data
-        }
-        if set(cond) == keys:
-            # field all exists
-            return session.query(model).filter_by(**cond).first()
-    return None
+    return _get_instance_by_keys(session, model, data)
 
 
 def get_instance_by_cond(session, father_instance, father_attr, model, data):
     """Retrieve an existing record by primary key(s) or unique key(s)."""
-    # m = m.data_bindings.parent.class_
-    # m.data_bindings.expression.clauses[0].left.table == sa_inspect(m).tables[0]
-    # query_condition.attr.parent_token.primaryjoin.clauses
-    from sqlalchemy.sql.elements import BinaryExpression
-    unique_list = [
-        get_primary_keys(model)
-    ]
     copy_data = dict(data)
-    father_mapper = sa_inspect(father_instance).mapper
-    father_table = father_mapper.tables[0]
-    clauses = (
-        [father_attr.expression]
-        if isinstance(father_attr.expression, BinaryExpression) else
-        father_attr.expression.clauses
-    )
-    for be in clauses:
-        if be.left.table == father_table:
-            father_val = getattr(father_instance, be.left.key)
-            child_key = be.right.key
-        elif be.right.table == father_table:
-            father_val = getattr(father_instance, be.right.key)
-            child_key = be.left.key
-        else:
-            # 多对多关系会捕获无效条件
-            # father_attr.prop.direction: sqlalchemy.util.langhelpers.symbol
-            continue
-        copy_data[child_key] = father_val
-    unique_list.extend(get_unique_keys_list(model))
-    for props in unique_list:
-        keys = set(prop.key for prop in props)
-        cond = {
-            key: copy_data[key]
-            for key in keys if key in copy_data
-        }
-        if set(cond) == keys:
-            # field all exists
-            return session.query(model).filter_by(**cond).first()
-    return None
+    father_info = get_model_info(sa_inspect(father_instance).mapper.class_)
+    for father_key, child_key in father_info.get_join_pairs(father_attr):
+        copy_data[child_key] = getattr(father_instance, father_key)
+    return _get_instance_by_keys(session, model, copy_data)
 
 
 def get_list_attr_query(resource, attr):
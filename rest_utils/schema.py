@@ -20,11 +20,12 @@ from marshmallow.compat import with_metaclass, iteritems
 from sqlalchemy import Integer, DateTime, Date, Numeric, JSON
 from sqlalchemy.orm.dynamic import AppenderQuery
 
-from .sa_util import get_instance, get_instance_by_cond
+from .sa_util import get_instance, get_instance_by_cond, InstanceIndex
 from .ma.convert import ModelConverter
 from .utils import add_padding_callback, check_need_modify
 from .ma import model_registry
 from .fields import Related
+from .ma.expand import ExpandPaths, has_expanded, is_expanded
 
 READONLY_METHODS = frozenset(('GET',))
 
@@ -63,6 +64,11 @@ DEFAULT_MODEL_OPTS = {
     "match_fields": [],  # 用于_match参数搜索的字段
     "results_per_page": 10,  # 默认每页返回数目。None则不限制返回条数
     "max_results_per_page": 100,  # 最大每页返回数目。None则不限制返回条数
+    "count_strategy": "exact",  # 列表总数统计方式: exact, window, estimate, cached, none。可被_count参数覆盖
+    "count_cache_ttl": 10,  # count_strategy为cached时的缓存秒数
+    "cache_ttl": None,  # 按主键查询单个资源的二级缓存秒数。None则不缓存
+    "response_cache_ttl": None,  # 列表查询的响应缓存秒数。None则不缓存
+    "bulk_write": True,  # 批量请求使用executemany写入。仅在使用默认create/created回调时生效
     "methods": READONLY_METHODS,  # 默认的HTTP方法
     "filters": default_filters,  # 查询时默认添加的orm filter
     "create": default_create,  # 创建实例回调方法。(instance, data)
@@ -312,9 +318,22 @@ class ModelSchema(with_metaclass(ModelSchemaMeta, ma.Schema)):
         # 创建资源之前先检查是否存在
         self._check_existence = check_existence
         self._related_kwargs = related_kwargs
+        # 批量反序列化时已存在的资源
+        self._instance_index = None
 
         super(ModelSchema, self).__init__(*args, **kwargs)
 
+    @ma.post_load(pass_many=True)
+    def prefetch_instances(self, data, many):
+        """
+        批量反序列化时一次查询所有已存在的资源, 在 make_instance 之前调用
+        """
+        if many and self._check_existence:
+            self._instance_index = InstanceIndex(self._session, self.model, data)
+        else:
+            self._instance_index = None
+        return data
+
     @ma.post_load
     def make_instance(self, data):
         """Deserialize data to an instance of the model. Update an existing row
@@ -324,7 +343,9 @@ class ModelSchema(with_metaclass(ModelSchemaMeta, ma.Schema)):
         """
         if self._check_existence:
             # 存在 _owner_query 则使用 ins.relationship.filter 查询
-            if self.many:
+            if self._instance_index is not None:
+                instance = self._instance_index.get(data)
+            elif self.many:
                 # 一般情况下都是schema 一对一 ins.如果用到了many,则只能重新查询一次
                 instance = get_instance(self._session, self.model, data)
             else:
@@ -339,12 +360,33 @@ class ModelSchema(with_metaclass(ModelSchemaMeta, ma.Schema)):
         add_padding_callback(self.opts.created, instance)  # commit数据库之后调用
         return instance
 
+    @classmethod
+    def get_dump_options(cls, expand, only=None, exclude=()):
+        """
+        计算序列化时实际使用的only和exclude, 排除未展开的fields.Related
+        :param expand: 当expand>=1或者None时，field.Related生效; ExpandPaths 只展开指定的关系
+        :param only:
+        :param exclude:
+        :return: (only, exclude)
+        """
+        if has_expanded(expand) and not isinstance(expand, ExpandPaths):
+            return only, exclude
+        new_exclude = list(exclude) if exclude else []
+        new_only = list(only) if only else []
+        for key, field in iteritems(cls._declared_fields):
+            if isinstance(field, Related) and not is_expanded(expand, key):
+                if key not in new_exclude:
+                    new_exclude.append(key)
+                if key in new_only:
+                    new_only.remove(key)
+        return new_only or only, new_exclude or exclude
+
     def dump(self, obj, many=None, expand=0, **kwargs):
         """
         serialize
         :param obj:
         :param many:
-        :param expand: 当expand>=1或者None时，field.Related生效，展开展开子资源
+        :param expand: 当expand>=1或者None时，field.Related生效，展开展开子资源. ExpandPaths 只展开指定的关系
         :param kwargs:
         :return:
         """
@@ -353,19 +395,7 @@ class ModelSchema(with_metaclass(ModelSchemaMeta, ma.Schema)):
         old_only = self.only
         try:
             self._current_expand = expand
-            if self._current_expand is not None and self._current_expand <= 0:
-                exclude = list(old_exclude) if old_exclude else []
-                only = list(old_only) if old_only else []
-                for key, field in iteritems(self._declared_fields):
-                    if isinstance(field, Related):
-                        if key not in exclude:
-                            exclude.append(key)
-                        if key in only:
-                            only.remove(key)
-                if exclude:
-                    self.exclude = exclude
-                if only:
-                    self.only = only
+            self.only, self.exclude = self.get_dump_options(expand, only=old_only, exclude=old_exclude)
             return super(ModelSchema, self).dump(obj, many=many, **kwargs)
         finally:
             self._current_expand = None
@@ -10,7 +10,7 @@ Desc    :
 import logging
 from sqlalchemy.orm.util import class_mapper, object_mapper
 from sqlalchemy.orm.exc import UnmappedInstanceError
-from flask import current_app, request, jsonify, g
+from flask import current_app, request, g
 from marshmallow.compat import iteritems
 from marshmallow import missing
 from ..exception import RequestHeadersContentTypeNotSupport
@@ -41,6 +41,10 @@ def jsonres(data):
     indent = None
     if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] and not request.is_xhr:
         indent = 2
+    api_manager = getattr(current_app, "api_manager", None)
+    if api_manager is not None:
+        # 使用APIManager配置的json编码后端, 自定义了 app.json_encoder 时使用flask编码
+        dumps = api_manager.json_dumps
     return current_app.response_class(
         dumps(data, indent=indent),
         mimetype='application/json'
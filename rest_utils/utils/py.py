@@ -9,6 +9,8 @@ Desc    :
 """
 import signal
 import bisect
+import time
+import threading
 import hashlib
 import socket
 import six
@@ -29,6 +31,7 @@ __all__ = [
     "get_system",
     "NullContext",
     "null_context",
+    "LRUCache",
 ]
 
 
@@ -233,6 +236,64 @@ class NullContext(object):
 
 null_context = NullContext()
 
+
+class LRUCache(object):
+    """
+    线程安全的LRU缓存, 可选过期时间
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=128, ttl=None):
+        """
+        :param maxsize: 最大条目数
+        :param ttl: 过期秒数, None则不过期
+        """
+        from collections import OrderedDict
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, self._missing)
+            if item is self._missing:
+                return default
+            value, expire_at = item
+            if expire_at is not None and expire_at <= time.time():
+                return default
+            # 重新插入, 移动到末尾
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expire_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expire_at)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, self._missing)
+        if item is self._missing:
+            return default
+        return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+
 if __name__ == '__main__':
     cr = ConsistentHashRing(100)
 
@@ -0,0 +1,341 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Author  :   windpro
+E-mail  :   windprog@gmail.com
+Date    :   2018/7/4
+Desc    :   查询条件表达式(_where)
+支持 and, or, not 和括号, 比较方式与查询参数一致:
+    /Invoice?_where=(Total__gt=10 or BillingCountry="USA") and not BillingState__isnull=true
+    /Track?_where=Name=%love% or Album.Title>=M
+比较符: =, !=, >, >=, <, <=, 或者字段名加操作符后缀(__gt, __between 等).
+值包含空格或括号时使用引号, 引号内用反斜杠转义.
+同一个model的同一个表达式只解析一次, 编译结果缓存在LRU中.
+"""
+import re
+
+from sqlalchemy import and_, or_, not_
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.elements import BinaryExpression
+
+from .exception import IllegalRequestData
+from .utils import LRUCache
+
+# 比较操作符后缀, 如 Total__gt=10, InvoiceDate__between=2009-01-01,2009-12-31
+FILTER_OPERATORS = ("gt", "gte", "lt", "lte", "ne", "between", "isnull")
+OPERATOR_SEP = "__"
+BOOL_VALUES = {"1": True, "true": True, "0": False, "false": False}
+
+# 比较符对应的操作符. eq 在值以%开头或结尾时为模糊查询
+SYMBOL_OPERATORS = {
+    "=": "eq",
+    "!=": "ne",
+    ">": "gt",
+    ">=": "gte",
+    "<": "lt",
+    "<=": "lte",
+}
+
+# 括号和not的最大嵌套层数
+MAX_DEPTH = 32
+# 缓存的表达式数量
+WHERE_CACHE_SIZE = 1024
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<lparen>\() |
+        (?P<rparen>\)) |
+        (?P<op>>=|<=|!=|=|>|<) |
+        (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+        (?P<word>[^\s()'"=<>!]+)
+    )""", re.VERBOSE)
+_ESCAPE_RE = re.compile(r"\\(.)")
+_NAME_RE = re.compile(r"^[A-Za-z_]\w*(\.[A-Za-z_]\w*)?$")
+_KEYWORDS = ("and", "or", "not")
+
+_compiled = LRUCache(maxsize=WHERE_CACHE_SIZE)
+
+
+def split_operator(key):
+    """
+    拆分查询参数的操作符后缀
+    :param key: 如 Total__gt
+    :return: (字段, 操作符), 没有操作符时为 (key, None)
+    """
+    if OPERATOR_SEP in key:
+        field, op = key.rsplit(OPERATOR_SEP, 1)
+        if field and op in FILTER_OPERATORS:
+            return field, op
+    return key, None
+
+
+def parse_operator_value(op, value):
+    """
+    转换操作符的参数值: between 为 [下限, 上限], isnull 为 bool
+    """
+    if op == "between":
+        value = value.split(',')
+        assert len(value) == 2, "__between value must be: min,max"
+    elif op == "isnull":
+        assert value.lower() in BOOL_VALUES, "__isnull value must be: true/false"
+        value = BOOL_VALUES[value.lower()]
+    return value
+
+
+def operator_filter(column, op, value):
+    """
+    生成比较条件
+    :param column: 模型属性
+    :param op: FILTER_OPERATORS 之一
+    :param value: parse_operator_value 的结果
+    :return:
+    """
+    if op == "gt":
+        return column > value
+    if op == "gte":
+        return column >= value
+    if op == "lt":
+        return column < value
+    if op == "lte":
+        return column <= value
+    if op == "ne":
+        return column != value
+    if op == "between":
+        return column.between(value[0], value[1])
+    if value:
+        return column.is_(None)
+    return column.isnot(None)
+
+
+def resolve_attribute(cls, key):
+    """
+    解析字段路径
+    :param cls: sa orm model
+    :param key: 如 Total 或者 Album.Title
+    :return: (关系属性 或者 None, 字段属性). 字段不存在时返回None
+    """
+    relationships = sa_inspect(cls).relationships
+    if '.' in key:
+        father_field, child_field = key.split('.', 1)
+        if father_field not in relationships:
+            return None
+        child_cls = relationships[father_field].mapper.class_
+        if child_field not in sa_inspect(child_cls).column_attrs:
+            return None
+        return relationships[father_field], getattr(child_cls, child_field)
+    if key not in sa_inspect(cls).column_attrs:
+        return None
+    return None, getattr(cls, key)
+
+
+def _semi_join_filter(cls, prop, conds):
+    """
+    集合关系使用不相关子查询: parent.id IN (SELECT child.parent_id FROM child WHERE ...),
+    多对多时子查询为关联表连接子资源表. 数据库可以执行为半连接, 不需要逐行执行 EXISTS.
+    子查询排除空外键, 否则在 not 中变为 NOT IN 时遇到 NULL 不返回任何结果.
+    关系条件不是简单的外键相等时返回None
+    """
+    child_mapper = prop.mapper
+    if len(child_mapper.tables) != 1 or child_mapper.local_table in sa_inspect(cls).tables:
+        # 自关联时子查询会被关联到外层查询
+        return None
+    if not isinstance(prop.primaryjoin, BinaryExpression):
+        return None
+    if prop.secondary is None:
+        if len(prop.local_remote_pairs) != 1:
+            return None
+        local, remote = prop.local_remote_pairs[0]
+        subquery = Query([remote]).filter(remote.isnot(None), *conds)
+    else:
+        if not isinstance(prop.secondaryjoin, BinaryExpression):
+            return None
+        if len(prop.synchronize_pairs) != 1 or len(prop.secondary_synchronize_pairs) != 1:
+            return None
+        local, secondary_local = prop.synchronize_pairs[0]
+        remote, secondary_remote = prop.secondary_synchronize_pairs[0]
+        subquery = Query([secondary_local]).join(
+            child_mapper.local_table, remote == secondary_remote
+        ).filter(secondary_local.isnot(None), *conds)
+    return local.in_(subquery.statement)
+
+
+def related_filter(cls, prop, conds):
+    """
+    子资源满足所有条件. 集合关系优先使用半连接子查询, 一对一/多对一使用 EXISTS
+    :param cls: sa orm model
+    :param prop: 关系属性
+    :param conds: 子资源字段的条件列表
+    :return:
+    """
+    attr = getattr(cls, prop.key)
+    if prop.uselist:
+        ret = _semi_join_filter(cls, prop, conds)
+        if ret is not None:
+            return ret
+        return attr.any(and_(*conds))
+    return attr.has(and_(*conds))
+
+
+def _syntax_error(expression, msg, pos=None):
+    prompt = u"Invalid _where: %s" % msg
+    if pos is not None:
+        prompt += u" at position %s" % pos
+    raise IllegalRequestData(dict(prompt=prompt, expression=expression))
+
+
+def tokenize(expression):
+    """
+    :return: [(类型, 值, 位置)]
+    """
+    tokens = []
+    pos = 0
+    length = len(expression)
+    while pos < length:
+        if expression[pos:].strip() == "":
+            break
+        match = _TOKEN_RE.match(expression, pos)
+        if match is None:
+            _syntax_error(expression, u"unexpected character", pos)
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = _ESCAPE_RE.sub(r"\1", value[1:-1])
+        tokens.append((kind, value, match.start(kind)))
+        pos = match.end()
+    return tokens
+
+
+class WhereParser(object):
+    """
+    递归下降解析, 直接生成 sqlalchemy 表达式
+    expr    := and_expr ("or" and_expr)*
+    and_expr:= not_expr ("and" not_expr)*
+    not_expr:= "not" not_expr | "(" expr ")" | compare
+    compare := name op value
+    """
+
+    def __init__(self, cls, expression):
+        self.cls = cls
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.pos = 0
+        self.depth = 0
+
+    def error(self, msg):
+        if self.pos < len(self.tokens):
+            _syntax_error(self.expression, msg, self.tokens[self.pos][2])
+        _syntax_error(self.expression, msg + u" at end")
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None, None
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error(u"unexpected end")
+        self.pos += 1
+        return token
+
+    def is_keyword(self, name):
+        kind, value, _ = self.peek()
+        return kind == "word" and value.lower() == name
+
+    def parse(self):
+        if not self.tokens:
+            self.error(u"empty expression")
+        ret = self.parse_or()
+        if self.pos != len(self.tokens):
+            self.error(u"unexpected token")
+        return ret
+
+    def parse_or(self):
+        items = [self.parse_and()]
+        while self.is_keyword("or"):
+            self.pos += 1
+            items.append(self.parse_and())
+        return items[0] if len(items) == 1 else or_(*items)
+
+    def parse_and(self):
+        items = [self.parse_not()]
+        while self.is_keyword("and"):
+            self.pos += 1
+            items.append(self.parse_not())
+        return items[0] if len(items) == 1 else and_(*items)
+
+    def parse_not(self):
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            self.error(u"expression too deep")
+        try:
+            if self.is_keyword("not"):
+                self.pos += 1
+                return not_(self.parse_not())
+            if self.peek()[0] == "lparen":
+                self.pos += 1
+                ret = self.parse_or()
+                if self.next()[0] != "rparen":
+                    self.pos -= 1
+                    self.error(u"missing )")
+                return ret
+            return self.parse_compare()
+        finally:
+            self.depth -= 1
+
+    def parse_compare(self):
+        kind, name, _ = self.next()
+        if kind != "word" or name.lower() in _KEYWORDS:
+            self.pos -= 1
+            self.error(u"field name expected")
+        key, op = split_operator(name)
+        resolved = resolve_attribute(self.cls, key) if _NAME_RE.match(key) else None
+        if resolved is None:
+            self.pos -= 1
+            self.error(u"unknown field %s" % key)
+        kind, symbol, _ = self.next()
+        if kind != "op":
+            self.pos -= 1
+            self.error(u"operator expected")
+        if op is None:
+            op = SYMBOL_OPERATORS[symbol]
+        elif symbol != "=":
+            self.pos -= 1
+            self.error(u"operator suffix must use =")
+        kind, value, _ = self.next()
+        if kind not in ("word", "string"):
+            self.pos -= 1
+            self.error(u"value expected")
+        prop, column = resolved
+        if op == "eq":
+            if value.startswith('%') or value.endswith('%'):
+                cond = column.like(value, escape='/')
+            else:
+                cond = column == value
+        else:
+            try:
+                value = parse_operator_value(op, value)
+            except AssertionError as e:
+                self.pos -= 1
+                self.error(u"%s" % e)
+            cond = operator_filter(column, op, value)
+        if prop is not None:
+            cond = related_filter(self.cls, prop, [cond])
+        return cond
+
+
+def compile_where(cls, expression):
+    """
+    编译 _where 表达式, 结果按 (model, 表达式) 缓存
+    :param cls: sa orm model
+    :param expression: 表达式字符串
+    :return: sqlalchemy 条件
+    """
+    key = (cls, expression)
+    ret = _compiled.get(key)
+    if ret is None:
+        ret = WhereParser(cls, expression).parse()
+        _compiled.set(key, ret)
+    return ret
@@ -10,6 +10,7 @@ Desc    :
 """Helper functions for unit tests."""
 import os
 import sys
+from contextlib import contextmanager
 
 PROJECT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if PROJECT_PATH not in sys.path:
@@ -73,6 +74,28 @@ class BetterJSONEncoder(json.JSONEncoder):
         return super(BetterJSONEncoder, self).default(obj)
 
 
+@contextmanager
+def count_statements(engine, prefix=None):
+    """Records the SQL statements executed by ``engine`` inside the
+    ``with`` block, optionally only those starting with ``prefix``::
+
+        with count_statements(self.engine, "SELECT") as statements:
+            self.req.get('/tag')
+        assert len(statements) == 1
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if prefix is None or statement.startswith(prefix):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 def force_content_type_jsonapi(test_client):
     """Ensures that all requests made by the specified Flask test client
     that include data have the correct :http:header:`Content-Type`
@@ -8,7 +8,7 @@ Date    :   2018/3/7
 Desc    :   
 """
 from sqlalchemy.orm import relationship, backref
-from base import ChinookMemoryManagerTestBase, SqliteManagerTestBase, loads, dumps
+from base import ChinookMemoryManagerTestBase, SqliteManagerTestBase, loads, dumps, count_statements
 
 
 class CollectionKeyAttributeTestCase(ChinookMemoryManagerTestBase):
@@ -483,6 +483,32 @@ class CollectionKeyTestCase(ChinookMemoryManagerTestBase):
         assert res.status_code == 400
         self.assertRestException(res, "IllegalRequestData")
 
+    def test_patch_not_unique_key_field(self):
+        """
+        key_field 不是唯一字段时只修改查找到的一个资源
+        :return:
+        """
+        with self.flaskapp.app_context():
+            track = self.session.query(self.Track).filter_by(Name=u'CollectionKeyTestCase_name').one()
+            self.session.add(self.Track(
+                Name=track.Name, MediaTypeId=track.MediaTypeId,
+                Milliseconds=track.Milliseconds, UnitPrice=track.UnitPrice,
+            ))
+            self.session.commit()
+        res = self.patch('/Track/@CollectionKeyTestCase_name', json={
+            u'Composer': u'patched',
+            u'MediaTypeId': 1,
+            u'Milliseconds': 343719,
+            u'UnitPrice': u'0.99',
+        })
+        assert res.status_code == 200
+        with self.flaskapp.app_context():
+            composers = [track.Composer for track in self.session.query(self.Track).filter_by(
+                Name=u'CollectionKeyTestCase_name'
+            )]
+        assert len(composers) == 2
+        assert composers.count(u'patched') == 1
+
     def test_notnull_field(self):
         # TODO 尚未测试完毕
         res = self.post('/Album/447', json={
@@ -1109,3 +1135,407 @@ class CollectionTestCase(SqliteManagerTestBase):
             }],
             u'total': 1
         }
+
+    def test_get_collection_eager_load_expand(self):
+        """
+        展开的子资源使用预加载, 查询次数与返回条数无关
+        :return:
+        """
+        with count_statements(self.engine) as statements:
+            result = self.get('/Invoice', params={
+                '_num': 50,
+                '_sort': 'InvoiceId',
+                '_expand': 2,
+            }).json()
+        assert result['total'] == 412
+        assert len(result['items']) == 50
+        customer = result['items'][0]['Customer']
+        assert customer['CustomerId'] == 2
+        assert customer['Employee']['LastName'] == 'Johnson'
+        assert 1 in [item['InvoiceId'] for item in customer['Invoices']]
+        # count, page, Customer.Invoices
+        assert len(statements) <= 3
+
+    def test_get_collection_fields_load_only(self):
+        """
+        _fields 限制返回字段时只查询需要的列, 主键和外键总是查询
+        :return:
+        """
+        with count_statements(self.engine) as statements:
+            result = self.get('/Track', params={
+                '_num': 10,
+                '_sort': 'TrackId',
+                '_expand': 1,
+                '_fields': "Track:TrackId,Name,Album;Album:Title",
+            }).json()
+        assert result['items'][0] == {
+            u'TrackId': 1,
+            u'Name': u'For Those About To Rock (We Salute You)',
+            u'Album': {u'Title': u'For Those About To Rock We Salute You'},
+        }
+        # count, page
+        assert len(statements) == 2
+        page = statements[-1]
+        assert "Composer" not in page
+        assert "UnitPrice" not in page
+        assert "AlbumId" in page
+
+    def test_get_collection_by_params_operators(self):
+        """
+        比较操作符后缀: __gt, __gte, __lt, __lte, __ne, __between, __isnull
+        :return:
+        """
+        with self.flaskapp.app_context():
+            from rest_utils.sa_util import get_session
+            from chinook_models import Invoice, Track
+
+            query = get_session().query(Invoice)
+            gt_num = query.filter(Invoice.Total > 10).count()
+            between_num = query.filter(Invoice.Total >= 5, Invoice.Total <= 10, Invoice.BillingState != None).count()
+            track_num = get_session().query(Track).filter(Track.Milliseconds < 100000, Track.GenreId != 1).count()
+        result = self.get('/Invoice', params={'Total__gt': 10, '_num': 0}).json()
+        assert result['total'] == gt_num
+        result = self.get('/Invoice', params={
+            'Total__between': '5,10',
+            'BillingState__isnull': 'false',
+            '_num': 0,
+        }).json()
+        assert result['total'] == between_num
+        result = self.get('/Track', params={
+            'Milliseconds__lt': 100000,
+            'GenreId__ne': 1,
+            '_num': 500,
+        }).json()
+        assert result['total'] == track_num
+        assert all(item['Milliseconds'] < 100000 for item in result['items'])
+        # 通过关系过滤: 有单曲时长超过1小时的播放列表
+        result = self.get('/Playlist', params={
+            'Track.Milliseconds__gte': 3600000,
+            '_num': 50,
+        }).json()
+        assert result['total'] > 0
+        assert self.get('/Invoice', params={'Total__between': '5'}).status_code == 400
+
+    def test_get_collection_by_params_where(self):
+        """
+        _where 表达式: and, or, not, 括号, 子资源字段
+        :return:
+        """
+        from sqlalchemy import or_, and_
+        from rest_utils.where import compile_where
+
+        with self.flaskapp.app_context():
+            from rest_utils.sa_util import get_session
+            from chinook_models import Invoice, Track, Album
+
+            query = get_session().query(Invoice)
+            expected = query.filter(or_(
+                Invoice.Total > 15,
+                and_(Invoice.BillingCountry == "Canada", Invoice.BillingState != None, Invoice.Total <= 1)
+            )).count()
+            track_num = get_session().query(Track).filter(
+                Track.Album.has(Album.Title.like("%Rock%")), Track.GenreId != 1
+            ).count()
+        result = self.get('/Invoice', params={
+            '_where': 'Total>15 or (BillingCountry="Canada" and not BillingState__isnull=true and Total__lte=1)',
+            '_num': 0,
+        }).json()
+        assert result['total'] == expected
+        result = self.get('/Track', params={
+            '_where': "Album.Title=%Rock% AND NOT GenreId=1",
+            '_num': 0,
+        }).json()
+        assert result['total'] == track_num
+        # 同一个表达式只编译一次
+        assert compile_where(Track, "Album.Title=%Rock% AND NOT GenreId=1") is \
+            compile_where(Track, "Album.Title=%Rock% AND NOT GenreId=1")
+        for where in ['Total>', '(Total>1', 'Total>1 or', 'Unknown=1', 'Total__gt>1', 'Total>1 Total<2']:
+            assert self.get('/Invoice', params={'_where': where}).status_code == 400
+
+    def test_get_collection_sort_by_related(self):
+        """
+        按关系字段排序, 使用外连接在数据库中排序和分页
+        :return:
+        """
+        with self.flaskapp.app_context():
+            from rest_utils.sa_util import get_session
+            from chinook_models import Track, Album, Artist
+
+            expected = [row[0] for row in get_session().query(Track.TrackId).outerjoin(Track.Album).outerjoin(
+                Album.Artist).order_by(Artist.Name.desc(), Album.Title, Track.TrackId).offset(20).limit(10)]
+        result = self.get('/Track', params={
+            '_page': 3,
+            '_num': 10,
+            '_orders[]': ['Album.Artist.Name:desc', 'Album.Title:asc', 'TrackId:asc'],
+            '_expand': 1,
+        }).json()
+        assert [item['TrackId'] for item in result['items']] == expected
+        assert result['total'] == 3503
+        result = self.get('/Track', params={'_sort': 'MediaType.Name', '_direction': 'desc', '_num': 1}).json()
+        # Purchased AAC audio file
+        assert result['items'][0]['MediaTypeId'] == 4
+        assert self.get('/Track', params={'_sort': 'PlaylistCollection.Name'}).status_code == 400
+        assert self.get('/Track', params={'_sort': 'Album.Unknown'}).status_code == 400
+
+    def test_get_collection_related_filter_join(self):
+        """
+        多对一子资源条件使用连接, 匹配多个子资源时也返回所有结果; 集合子资源使用半连接子查询
+        :return:
+        """
+        with self.flaskapp.app_context():
+            from rest_utils.sa_util import get_session
+            from chinook_models import Invoice, Customer, Playlist, Track
+
+            invoice_num = get_session().query(Invoice).join(Invoice.Customer).filter(
+                Customer.Country == "USA", Customer.City != "Boston").count()
+            playlist_num = get_session().query(Playlist).filter(Playlist.Track.any(Track.Name.like("%Love%"))).count()
+        with count_statements(self.engine) as statements:
+            result = self.get('/Invoice', params={
+                'Customer.Country': 'USA',
+                'Customer.City__ne': 'Boston',
+                '_num': 5,
+            }).json()
+            assert result['total'] == invoice_num
+            # count, page
+            assert len(statements) == 2
+            assert all(" JOIN " in statement and "EXISTS" not in statement for statement in statements)
+            del statements[:]
+            result = self.get('/Playlist', params={'Track.Name': '%Love%', '_num': 0}).json()
+            assert result['total'] == playlist_num
+            assert "EXISTS" not in statements[0]
+            assert "IN (SELECT" in statements[0]
+
+    def test_dump_plan_same_as_schema(self):
+        """
+        序列化计划的结果与marshmallow序列化一致, 且同一组参数只编译一次
+        :return:
+        """
+        from rest_utils.ma.model_registry import auto_build_schema
+        from rest_utils.ma.plan import get_dump_plan
+
+        schema = auto_build_schema(self.Invoice)
+        invoice = self.session.query(self.Invoice).get(1)
+        related_kwargs = {schema: {"exclude": ["BillingCity"]}}
+        for expand in (0, 1, 2):
+            plan = get_dump_plan(schema, expand, related_kwargs=related_kwargs, exclude=["BillingCity"])
+            assert plan is get_dump_plan(schema, expand, related_kwargs=related_kwargs, exclude=["BillingCity"])
+            data, errors = schema(related_kwargs=related_kwargs, exclude=["BillingCity"]).dump(invoice, expand=expand)
+            assert not errors
+            assert plan.dump(invoice) == data
+            assert "BillingCity" not in data
+        assert "Customer" not in get_dump_plan(schema, 0).dump(invoice)
+
+    def test_get_collection_count_strategy(self):
+        """
+        _count 参数选择总数统计方式
+        :return:
+        """
+        params = {'_num': 10, '_page': 2, '_sort': 'InvoiceId', 'BillingCountry': 'USA'}
+        exact = self.get('/Invoice', params=params).json()
+        assert exact['total'] == 91
+        for strategy in ('window', 'estimate', 'cached'):
+            result = self.get('/Invoice', params=dict(params, _count=strategy)).json()
+            assert result == exact
+        # 超出最后一页
+        result = self.get('/Invoice', params=dict(params, _count='window', _page=100)).json()
+        assert result == {u'items': [], u'total': 91}
+
+    def test_get_collection_count_none(self):
+        result = self.get('/Invoice', params={'_num': 10, '_page': 9, '_count': 'none', 'BillingCountry': 'USA'}).json()
+        assert 'total' not in result
+        assert result['has_more'] is True
+        assert len(result['items']) == 10
+        result = self.get('/Invoice', params={'_num': 10, '_page': 10, '_count': 'none', 'BillingCountry': 'USA'}).json()
+        assert result['has_more'] is False
+        assert len(result['items']) == 1
+        assert self.get('/Invoice', params={'_count': 'all'}).status_code == 400
+        # 不分页时仍然排序
+        params = {'_sort': 'InvoiceId', '_direction': 'desc', '_count': 'none', 'BillingCountry': 'USA'}
+        for extra in ({}, {'_num': -1, '_include': 'Customer'}):
+            result = self.get('/Invoice', params=dict(params, **extra)).json()
+            ids = [item['InvoiceId'] for item in result['items']]
+            assert len(ids) == 91
+            assert ids == sorted(ids, reverse=True)
+
+    def test_get_collection_cursor(self):
+        """
+        游标分页与页码分页的结果一致
+        :return:
+        """
+        for field, direction in (('CustomerId', 'asc'), ('Total', 'desc')):
+            params = {'_num': 100, '_sort': field, '_direction': direction}
+            expected = []
+            for page in range(1, 6):
+                result = self.get('/Invoice', params={
+                    '_num': 100, '_page': page, '_orders': '%s:%s,InvoiceId:asc' % (field, direction),
+                }).json()
+                expected.extend(item['InvoiceId'] for item in result['items'])
+
+            ids = []
+            cursor = ''
+            while cursor is not None:
+                result = self.get('/Invoice', params=dict(params, _cursor=cursor)).json()
+                assert result['total'] == 412
+                ids.extend(item['InvoiceId'] for item in result['items'])
+                cursor = result['next_cursor']
+            assert len(ids) == 412
+            assert ids == expected
+
+        result = self.get('/Invoice', params={'_num': 10, '_sort': 'InvoiceDate', '_cursor': ''}).json()
+        # 排序条件变化后游标失效
+        res = self.get('/Invoice', params={'_num': 10, '_sort': 'Total', '_after': result['next_cursor']})
+        assert res.status_code == 400
+        assert self.get('/Invoice', params={'_cursor': 'invalid'}).status_code == 400
+        # 篡改的游标: 值的个数或者类型与排序字段不一致
+        from rest_utils.cursor import encode_cursor, decode_cursor
+        values, order_key = decode_cursor(result['next_cursor'])
+        for tampered in (values[:1], [u'invalid', values[1]], [values[0], {u'a': 1}]):
+            params = {'_num': 10, '_sort': 'InvoiceDate', '_cursor': encode_cursor(tampered, order_key)}
+            res = self.get('/Invoice', params=params)
+            assert res.status_code == 400
+            self.assertRestException(res, "IllegalRequestData")
+
+    def test_get_collection_stream_all(self):
+        """
+        _num=-1 时流式返回, 结果与一次性返回一致
+        :return:
+        """
+        params = {'_num': -1, '_sort': 'InvoiceId', '_expand': 1, 'BillingCountry': 'USA'}
+        expected = self.get('/Invoice', params=params).json()
+        self.manager.stream_results = True
+        try:
+            res = self.get('/Invoice', params=params)
+            assert res.status_code == 200
+            streamed = res.json()
+            result = self.get('/Invoice', params={'_num': -1, '_count': 'none', 'BillingCountry': 'NotExist'}).json()
+        finally:
+            self.manager.stream_results = False
+        assert streamed['total'] == 91
+        assert len(streamed['items']) == 91
+        assert streamed == expected
+        assert result == {u'has_more': False, u'items': []}
+
+    def test_dump_plan_memo(self):
+        """
+        同一个响应中重复引用的子资源只序列化一次
+        :return:
+        """
+        from rest_utils.ma.model_registry import auto_build_schema
+        from rest_utils.ma.plan import get_dump_plan, DumpMemo
+
+        schema = auto_build_schema(self.Track)
+        plan = get_dump_plan(schema, 2)
+        tracks = self.session.query(self.Track).filter(self.Track.AlbumId == 1).order_by(self.Track.TrackId).all()
+        memo = DumpMemo()
+        first, second = [plan.dump(track, memo) for track in tracks[:2]]
+        assert first['Genre'] is second['Genre']
+        assert first['Album'] is second['Album']
+        assert first['Album']['Artist']['Name'] == 'AC/DC'
+        assert plan.dump(tracks[0]) == first
+        # 超过上限后不再缓存
+        memo = DumpMemo(maxsize=0)
+        first, second = [plan.dump(track, memo) for track in tracks[:2]]
+        assert first['Genre'] is not second['Genre']
+        assert first['Genre'] == second['Genre']
+
+    def test_dump_plan_related_default(self):
+        """
+        关系字段没有值时使用默认值, 默认值是函数时调用
+        :return:
+        """
+        import copy
+        from rest_utils.ma.model_registry import auto_build_schema
+        from rest_utils.ma.plan import _compile_related
+
+        schema = auto_build_schema(self.Track)
+        field = copy.copy(schema._declared_fields['Album'])
+        field.default = lambda: {u'AlbumId': None}
+        getter = _compile_related('Album', field, schema, 1, {})
+        assert getter(object(), None) == {u'AlbumId': None}
+
+    def test_get_collection_include(self):
+        """
+        _include 返回去重的关联资源, 每个关系一次批量查询
+        :return:
+        """
+        with count_statements(self.engine) as statements:
+            result = self.get('/Track', params={
+                'AlbumId': 1,
+                '_sort': 'TrackId',
+                '_include': 'Album,Album.Artist,Genre',
+            }).json()
+        # count, page, Album, Artist, Genre
+        assert len(statements) == 5
+        assert result['total'] == 10
+        assert [item['Album'] for item in result['items']] == [1] * 10
+        assert result['items'][0]['Genre'] == 1
+        assert 'MediaType' not in result['items'][0]
+        assert result['included']['Album'] == {
+            u'1': {u'AlbumId': 1, u'ArtistId': 1, u'Artist': 1, u'Title': u'For Those About To Rock We Salute You'},
+        }
+        assert result['included']['Artist'] == {u'1': {u'ArtistId': 1, u'Name': u'AC/DC'}}
+        assert list(result['included']['Genre'].keys()) == [u'1']
+
+        result = self.get('/Invoice/1', params={'_include': 'Customer,Customer.Invoices'}).json()
+        assert result['InvoiceId'] == 1
+        assert result['Customer'] == 2
+        customer = result['included']['Customer'][u'2']
+        assert 1 in customer['Invoices']
+        assert sorted(result['included']['Invoice'].keys()) == sorted(str(key) for key in customer['Invoices'])
+
+        assert self.get('/Track', params={'_include': 'NotExist'}).status_code == 400
+
+    def test_get_collection_expand_paths(self):
+        """
+        _expand 按关系名称展开
+        :return:
+        """
+        with count_statements(self.engine) as statements:
+            result = self.get('/Track', params={
+                'AlbumId': 1,
+                '_num': 2,
+                '_sort': 'TrackId',
+                '_expand': 'Album.Artist,Genre',
+            }).json()
+        # count, page(join Album, Artist, Genre)
+        assert len(statements) == 2
+        item = result['items'][0]
+        assert item['Album']['Artist'] == {u'ArtistId': 1, u'Name': u'AC/DC'}
+        assert item['Genre'] == {u'GenreId': 1, u'Name': u'Rock'}
+        assert 'MediaType' not in item
+        assert 'PlaylistCollection' not in item
+        assert 'Tracks' not in item['Album']
+
+        res = self.get('/Track/1', params={'_expand': 'MediaType'})
+        assert res.json()['MediaType'] == {u'MediaTypeId': 1, u'Name': u'MPEG audio file'}
+        assert 'Album' not in res.json()
+        assert self.get('/Track/1', params={'_expand': '-1'}).status_code == 400
+        # 不存在的关系或者不是关系的字段
+        assert self.get('/Track', params={'_expand': 'NotExist'}).status_code == 400
+        assert self.get('/Track', params={'_expand': 'Album.NotExist'}).status_code == 400
+        res = self.get('/Track/1', params={'_expand': 'Album.Title'})
+        assert res.status_code == 400
+        self.assertRestException(res, "IllegalRequestData")
+
+    def test_get_collection_expand_limit(self):
+        """
+        _expand_limit 限制展开的集合条数, 并返回集合总数
+        :return:
+        """
+        params = {'_num': 5, '_sort': 'PlaylistId', '_expand': 'Track.Album'}
+        expected = self.get('/Playlist', params=params).json()
+
+        with count_statements(self.engine) as statements:
+            result = self.get('/Playlist', params=dict(params, _expand_limit=3)).json()
+        # count, page, Track(window, join Album)
+        assert len(statements) == 3
+        assert result['total'] == expected['total']
+        for item, full in zip(result['items'], expected['items']):
+            assert item['_counts'] == {u'Track': len(full['Track'])}
+            full_tracks = sorted(full['Track'], key=lambda track: track['TrackId'])[:3]
+            assert item['Track'] == full_tracks
+        assert result['items'][0]['Track'][0]['Album']['AlbumId'] == 1
+
+        result = self.get('/Playlist/1', params={'_expand': 'Track', '_expand_limit': 0}).json()
+        assert result['Track'] == []
+        assert result['_counts'] == {u'Track': 3290}
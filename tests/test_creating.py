@@ -36,6 +36,7 @@ from sqlalchemy.orm import relationship
 
 from base import APIManager
 from base import BetterJSONEncoder as JSONEncoder
+from base import count_statements
 from base import dumps
 from base import loads
 from base import FlaskSQLAlchemyTestBase
@@ -157,6 +158,229 @@ class TestCreating(MemoryManagerTestBase):
         response = self.req.delete('/tag/404')
         assert response.status_code == 404
 
+    def test_delete_muti_resource(self):
+        """
+        批量删除使用 DELETE ... WHERE id IN (...)
+        :return:
+        """
+        self.post('/tag', json=[{u"id": idx, u"name": u'delete%d' % idx} for idx in range(1, 6)])
+        with count_statements(self.engine, "DELETE") as statements:
+            res = self.delete('/tag', json=[{u"id": 1}, {u"id": 2}, {u"id": 3}])
+        assert res.status_code == 204
+        assert len(statements) == 1
+        assert sorted(tag.id for tag in self.session.query(self.Tag)) == [4, 5]
+
+        # 资源不存在时不删除
+        res = self.delete('/tag', json=[{u"id": 4}, {u"id": 404}])
+        assert res.status_code == 404
+        assert self.session.query(self.Tag).count() == 2
+
+        # 与数据库一样, 字符串主键值也能匹配, 且不需要逐个查询
+        with count_statements(self.engine, "SELECT") as statements:
+            res = self.delete('/tag', json=[{u"id": u"4"}])
+        assert len(statements) == 1
+        assert res.status_code == 204
+        assert [tag.id for tag in self.session.query(self.Tag)] == [5]
+
+    def test_delete_by_filter(self):
+        """
+        按查询条件删除
+        :return:
+        """
+        self.post('/tag', json=[{u"name": u'filter_delete%d' % idx} for idx in range(3)] + [{u"name": u'keep'}])
+        res = self.req.delete('/tag')
+        self.assertRestException(res, u"IllegalRequestData")
+        res = self.req.delete('/tag', query_string={"name": "filter_delete%"})
+        assert res.status_code == 204
+        assert [tag.name for tag in self.session.query(self.Tag)] == [u'keep']
+
+    def test_patch_by_filter(self):
+        """
+        按查询条件修改
+        :return:
+        """
+        self.post('/tag', json=[{u"name": u'patch%d' % idx} for idx in range(3)] + [{u"name": u'keep'}])
+        with count_statements(self.engine, "UPDATE") as statements:
+            res = self.patch('/tag?name=patch%', json={u"name": u'patched'})
+        assert res.status_code == 200
+        assert loads(res.data) == {"count": 3}
+        assert len(statements) == 1
+        assert self.session.query(self.Tag).filter_by(name=u'patched').count() == 3
+
+        # 返回修改后的资源
+        res = self.patch('/tag?name=patched&_returning=1', json={u"name": u'patched2'})
+        data = loads(res.data)
+        assert data["count"] == 3
+        assert [item["name"] for item in data["items"]] == [u'patched2'] * 3
+
+        # 校验错误和不能修改的字段
+        res = self.patch('/tag?name=keep', json={u"name": 1})
+        assert res.status_code == 400
+        res = self.patch('/tag?name=keep', json={u"id": 100})
+        self.assertRestException(res, u"IllegalRequestData")
+
+    def test_where_not_related_with_null_fk(self):
+        """
+        not 集合子资源条件: 子资源外键为空时结果与 EXISTS 一致
+        :return:
+        """
+        from rest_utils.where import compile_where
+
+        Person, Article = self.Person, self.Article
+        session = self.session
+        session.add_all([
+            Person(id=1, name=u'p1'), Person(id=2, name=u'p2'),
+            Article(id=1, author_id=1, type=u'x'),
+            Article(id=2, author_id=2, type=u'y'),
+            Article(id=3, author_id=None, type=u'x'),
+        ])
+        session.commit()
+        cond = compile_where(Person, "not articles.type=x")
+        assert [person.id for person in session.query(Person).filter(cond)] == [2]
+        expected = session.query(Person).filter(~Person.articles.any(Article.type == u'x')).all()
+        assert session.query(Person).filter(cond).all() == expected
+
+    def test_model_info(self):
+        """
+        注册时计算的model元数据
+        :return:
+        """
+        from rest_utils.sa_util import get_model_info
+
+        info = get_model_info(self.Person)
+        assert info is get_model_info(self.Person)
+        assert info.key_plans == [("id",), ("name",)]
+        assert info.match_key_plan({"name": u"windpro"}) == ("name",)
+        assert info.match_key_plan({"age": 1}) is None
+        assert info.route_key == "id" and info.route_key_type is int
+        assert info.get_join_pairs(self.Person.articles) == [("id", "author_id")]
+
+    def test_get_one_model_cache(self):
+        """
+        cache_ttl: 按主键查询单个资源使用二级缓存, 写请求之后失效
+        :return:
+        """
+        from rest_utils.cache import model_cache
+
+        self.manager.schemas['tag'].opts.cache_ttl = 60
+        self.post_response()
+        try:
+            with count_statements(self.engine, "SELECT") as statements:
+                assert loads(self.req.get('/tag/1').data)["name"] == u'Jeff Knupp'
+                assert len(statements) == 1
+                assert loads(self.req.get('/tag/1').data)["name"] == u'Jeff Knupp'
+                assert len(statements) == 1
+                # 写请求返回修改后的资源, 不使用缓存
+                res = self.patch('/tag/1', json={u"name": u'cached'})
+                assert loads(res.data)["name"] == u'cached'
+                assert loads(self.req.get('/tag/1').data)["name"] == u'cached'
+        finally:
+            model_cache.clear()
+
+    def test_get_response_cache(self):
+        """
+        response_cache_ttl: 列表查询缓存响应内容, 写请求之后失效
+        :return:
+        """
+        import gzip
+        from io import BytesIO
+        from rest_utils.cache import response_cache
+
+        self.manager.schemas['tag'].opts.response_cache_ttl = 60
+        self.post_response()
+        try:
+            with count_statements(self.engine, "SELECT") as statements:
+                data = self.req.get('/tag?_num=5').data
+                count = len(statements)
+                assert count > 0
+                assert self.req.get('/tag?_num=5').data == data
+                assert len(statements) == count
+                # 参数顺序不影响缓存
+                self.req.get('/tag?_num=5&_expand=0')
+                count = len(statements)
+                self.req.get('/tag?_expand=0&_num=5')
+                assert len(statements) == count
+                res = self.req.get('/tag?_num=5', headers={"Accept-Encoding": "gzip"})
+                if res.headers.get("Content-Encoding") == "gzip":
+                    assert gzip.GzipFile(fileobj=BytesIO(res.data)).read() == data
+                else:
+                    assert res.data == data
+                self.post('/tag', json={u"name": u'response_cache'})
+                items = loads(self.req.get('/tag?_num=5').data)["items"]
+                assert len(statements) > count
+                assert u'response_cache' in [item["name"] for item in items]
+            # 未压缩的响应也需要 Vary
+            assert self.req.get('/tag?_num=5').headers.get("Vary") == "Accept-Encoding"
+        finally:
+            response_cache.clear()
+
+    def test_get_response_cache_filters(self):
+        """
+        response_cache_ttl: schema 的 filters 按请求过滤时, 不同的条件不共享缓存
+        :return:
+        """
+        from rest_utils.cache import response_cache
+
+        current = {"name": u'tenant1'}
+        self.manager.schemas['tag'].opts.response_cache_ttl = 60
+        self.manager.schemas['tag'].opts.filters = lambda: [self.Tag.name == current["name"]]
+        self.post('/tag', json=[{u"name": u'tenant1'}, {u"name": u'tenant2'}])
+        try:
+            items = loads(self.req.get('/tag').data)["items"]
+            assert [item["name"] for item in items] == [u'tenant1']
+            current["name"] = u'tenant2'
+            items = loads(self.req.get('/tag').data)["items"]
+            assert [item["name"] for item in items] == [u'tenant2']
+        finally:
+            response_cache.clear()
+
+    def test_shared_generations(self):
+        """
+        多个进程映射同一个文件共享表版本号
+        :return:
+        """
+        import os
+        import tempfile
+        from rest_utils.cache import TableGenerations
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        worker1, worker2 = TableGenerations(), TableGenerations()
+        try:
+            worker1.use_shared(path)
+            worker2.use_shared(path)
+            before = worker2.get_many(["tag", "person"])
+            worker1.bump(["tag"])
+            after = worker2.get_many(["tag", "person"])
+            assert after[0] == before[0] + 1
+            assert after[1] == before[1]
+        finally:
+            worker1._shared.close()
+            worker2._shared.close()
+            os.remove(path)
+
+    def test_share_cache_generations_file(self):
+        """
+        worker 退出时不删除共享文件, master 退出时删除
+        :return:
+        """
+        import os
+        from rest_utils.flask_engine import share_cache_generations
+
+        options = {}
+        path = share_cache_generations(options)
+        pid = os.fork()
+        if pid == 0:
+            # 模拟 gunicorn worker 退出
+            try:
+                options["post_fork"](None, None)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert os.path.exists(path)
+        options["on_exit"](None)
+        assert not os.path.exists(path)
+
     def test_post_muti_resource(self):
         """
         批量创建
@@ -203,6 +427,32 @@ class TestCreating(MemoryManagerTestBase):
         assert self.session.query(self.Tag).filter_by(name=u'ready exist').count() == 0
         self.assertRestException(res, u"ResourcesAlreadyExists")
 
+    def test_post_bulk_resource(self):
+        """
+        批量创建使用 executemany 写入
+        :return:
+        """
+        with count_statements(self.engine, "INSERT") as statements:
+            res = self.post('/tag', json=[
+                {u"id": 10 + idx, u"name": u'bulk_create%d' % idx}
+                for idx in range(5)
+            ])
+        assert res.status_code == 201
+        assert [item["id"] for item in loads(res.data)] == [10, 11, 12, 13, 14]
+        assert len(statements) == 1
+        assert self.session.query(self.Tag).count() == 5
+
+        # 未指定主键时返回数据库生成的主键
+        res = self.post('/tag', json=[{u"name": u'bulk_auto1'}, {u"name": u'bulk_auto2'}])
+        assert res.status_code == 201
+        assert [item["name"] for item in loads(res.data)] == [u'bulk_auto1', u'bulk_auto2']
+        assert all(item["id"] for item in loads(res.data))
+
+        # 校验错误时整批不写入
+        res = self.post('/tag', json=[{u"name": u'bulk_error'}, {u"name": 1}])
+        assert res.status_code == 400
+        assert self.session.query(self.Tag).filter_by(name=u'bulk_error').count() == 0
+
     def test_get_not_exist_path(self):
         res = self.req.get('/person/1')
         self.assertRestException(res, u"AccessDenied")
@@ -244,6 +494,46 @@ class TestCreating(MemoryManagerTestBase):
         for item in now_items:
             assert item['name'].endswith('_update')
 
+    def test_put_muti_resource_lookup(self):
+        """
+        批量修改时一次查询所有已存在的资源
+        :return:
+        """
+        self.post('/tag', json=[{u"id": idx, u"name": u'lookup%d' % idx} for idx in range(1, 6)])
+        with count_statements(self.engine, "SELECT") as statements:
+            res = self.put('/tag', json=[
+                {u"id": idx, u"name": u'lookup%d_update' % idx}
+                for idx in range(1, 8)
+            ])
+        statements = [statement for statement in statements if "FROM tag" in statement]
+        assert res.status_code == 200
+        assert [item["name"] for item in loads(res.data)] == [u'lookup%d_update' % idx for idx in range(1, 8)]
+        # 查找已存在的资源只使用一次 IN 查询, commit 之后刷新资源使用一次 IN 查询
+        assert not [statement for statement in statements if "LIMIT" in statement]
+        assert len(statements) == 2
+        assert self.session.query(self.Tag).count() == 7
+
+    def test_put_muti_resource_collation(self):
+        """
+        批量修改和删除时按数据库的比较规则查找已存在的资源, 如不区分大小写的唯一字段
+        :return:
+        """
+        class Label(self.Base):
+            __tablename__ = 'label'
+            id = Column(Integer, primary_key=True)
+            name = Column(Unicode(collation="NOCASE"), unique=True)
+
+        self.Base.metadata.create_all()
+        self.manager.add(Label, methods=['GET', 'POST', "PUT", "DELETE"])
+        res = self.post('/label', json=[{u"name": u'Alpha'}, {u"name": u'Beta'}])
+        assert res.status_code == 201
+        res = self.put('/label', json=[{u"name": u'alpha'}, {u"name": u'gamma'}])
+        assert res.status_code == 200
+        assert sorted(label.name for label in self.session.query(Label)) == [u'Beta', u'alpha', u'gamma']
+        res = self.delete('/label', json=[{u"name": u'BETA'}])
+        assert res.status_code == 204
+        assert self.session.query(Label).count() == 2
+
     def test_put_one_resource(self):
         """
         单个修改
@@ -271,6 +561,39 @@ class TestCreating(MemoryManagerTestBase):
         for item in now_items:
             assert item['name'].endswith('_update')
 
+    def test_patch_one_resource(self):
+        """
+        部分修改单个资源时不预先查询
+        :return:
+        """
+        self.post_response()
+        with count_statements(self.engine) as statements:
+            res = self.patch('/tag/1', json={u"name": u'patched'})
+        statements = [statement.split(' ', 1)[0] for statement in statements]
+        assert res.status_code == 200
+        assert loads(res.data) == {u"id": 1, u"name": u'patched'}
+        assert statements[0] == "UPDATE"
+        assert statements.count("SELECT") <= 1
+        assert self.session.query(self.Tag).get(1).name == u'patched'
+
+        res = self.patch('/tag/404', json={u"name": u'patched'})
+        assert res.status_code == 404
+
+    def test_update_one_row_count(self):
+        """
+        update_one 不支持 RETURNING 时执行 UPDATE, 返回匹配的行数, 实例为None
+        :return:
+        """
+        from rest_utils.bulk import update_one
+
+        self.post('/tag', json=[{u"id": 1, u"name": u'same'}, {u"id": 2, u"name": u'same'}, {u"id": 3}])
+        assert update_one(self.session, self.Tag, [self.Tag.id == 3], {"name": u'one'}) == (1, None)
+        assert update_one(self.session, self.Tag, [self.Tag.id == 404], {"name": u'none'}) == (0, None)
+        # 条件不唯一时修改所有匹配的行, 所以 PATCH 只对主键和唯一字段使用 update_one
+        assert update_one(self.session, self.Tag, [self.Tag.name == u'same'], {"name": u'many'}) == (2, None)
+        self.session.commit()
+        assert sorted(tag.name for tag in self.session.query(self.Tag)) == [u'many', u'many', u'one']
+
     def test_post_collection_sure_id(self):
         # put json data
         res = self.req.put('/tag/99988', data={
@@ -368,6 +691,97 @@ class TestGetting(SqliteManagerTestBase):
         })
         assert res.json()['total'] == 6
 
+    def test_get_one_model_cache_expand(self):
+        """
+        cache_ttl: 展开子资源时不使用只有字段值的缓存, 子资源仍然预加载
+        :return:
+        """
+        from rest_utils.cache import model_cache
+
+        with count_statements(self.engine, "SELECT") as statements:
+            expected = self.get('/tracks/1', params={'_expand': 1}).json()
+        count = len(statements)
+        self.manager.schemas['tracks'].opts.cache_ttl = 60
+        try:
+            self.get('/tracks/1')
+            with count_statements(self.engine, "SELECT") as statements:
+                assert self.get('/tracks/1', params={'_expand': 1}).json() == expected
+            assert len(statements) == count
+        finally:
+            model_cache.clear()
+
+    def test_json_backend(self):
+        """json编码后端使用类型分派表转换非原生类型"""
+        import uuid
+        from decimal import Decimal
+        from rest_utils.encoder import get_json_backend
+
+        class Custom(object):
+            def __json__(self):
+                return {"custom": True}
+
+        backend = get_json_backend("stdlib")
+        value = uuid.uuid4()
+        data = loads(backend.dumps({
+            "price": Decimal("0.99"),
+            "uuid": value,
+            "custom": Custom(),
+            "date": datetime(2018, 6, 27, 8, 30),
+            u"名称": u"中文",
+        }))
+        assert data == {
+            "price": "0.99",
+            "uuid": str(value),
+            "custom": {"custom": True},
+            "date": "Wed, 27 Jun 2018 08:30:00 GMT",
+            u"名称": u"中文",
+        }
+        self.assertRaises(TypeError, backend.dumps, {"obj": object()})
+
+        expected = self.get('/tracks/1', params={'_expand': 1}).json()
+        self.manager.json_backend = backend
+        assert self.get('/tracks/1', params={'_expand': 1}).json() == expected
+
+    def test_json_backend_decimal(self):
+        """各个json后端的 Decimal 输出与标准库一致"""
+        from decimal import Decimal
+        from rest_utils.encoder import get_json_backend, UjsonBackend
+
+        data = {"price": Decimal("0.99"), "big": Decimal("12345678901234567890.12")}
+        expected = get_json_backend("stdlib").dumps(data, sort_keys=True)
+        assert loads(expected) == {"price": "0.99", "big": "12345678901234567890.12"}
+        assert get_json_backend("auto").dumps(data, sort_keys=True) == expected
+        if UjsonBackend.available():
+            assert loads(get_json_backend("ujson").dumps(data)) == loads(expected)
+
+    def test_json_sort_keys(self):
+        """JSON_SORT_KEYS 为真时按key排序"""
+        from rest_utils.utils import jsonres
+
+        data = dict((key, idx) for idx, key in enumerate("zyxabc"))
+        with self.flaskapp.test_request_context('/'):
+            self.flaskapp.config['JSON_SORT_KEYS'] = True
+            assert jsonres(data).get_data() == dumps(data, sort_keys=True, indent=2, separators=(",", ": ")).encode()
+
+    def test_json_custom_encoder(self):
+        """自定义了 app.json_encoder 时使用flask的json编码"""
+        from datetime import timedelta
+        from rest_utils.utils import jsonres
+
+        self.flaskapp.json_encoder = JSONEncoder
+        with self.flaskapp.test_request_context('/'):
+            assert loads(jsonres({"t": timedelta(seconds=5)}).get_data()) == {"t": 5}
+
+    def test_json_escape_non_ascii(self):
+        """orjson 不支持 ensure_ascii, 编码之后转义非ascii字符"""
+        from rest_utils.encoder import escape_non_ascii
+
+        data = dumps({u"名称": u"中文\U0001F600", "a": 1}, ensure_ascii=False).encode("utf-8")
+        escaped = escape_non_ascii(data)
+        escaped.decode("ascii")
+        assert loads(escaped) == loads(data)
+        assert escape_non_ascii(b'{"a":1}') == b'{"a":1}'
+
     # def test_get_etag_header(self):
     #     # TODO 实现ETAG
     #     """Does GETing a resource with the ETag header return a 304?"""